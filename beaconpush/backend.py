@@ -0,0 +1,138 @@
+# coding=UTF-8
+from thrift.Thrift import TType, TMessageType, TApplicationException
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from thrift.transport.TTransport import TMemoryBuffer
+
+from beaconpush.generated_thrift import BackendService
+
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
+class PreparedMessage(object):
+    """
+    A message that is encoded, and serialized for Thrift, only once.
+
+    It can be sent any number of times, to any nodes and target lists, with
+    only the target list being serialized for each call. Create them with
+    Client.prepare().
+    """
+    def __init__(self, data):
+        """
+        @param data: The encoded message, a string
+        """
+        self.data = data
+        self._tails = {} # {sphere: serialized fields}
+
+    def tail(self, sphere):
+        """
+        tail(sphere) -> string
+
+        @returns the serialized data and sphere fields of a sendUserMessage/sendChannelMessage call,
+                 that is everything following the target list up to the end of the arguments.
+        """
+        try:
+            return self._tails[sphere]
+        except KeyError:
+            buf = TMemoryBuffer()
+            protocol = TBinaryProtocol(buf)
+            protocol.writeFieldBegin('data', TType.STRING, 2)
+            protocol.writeString(self.data)
+            protocol.writeFieldEnd()
+            protocol.writeFieldBegin('sphere', TType.STRING, 3)
+            protocol.writeString(sphere)
+            protocol.writeFieldEnd()
+            protocol.writeFieldStop()
+
+            tail = self._tails[sphere] = buf.getvalue()
+            return tail
+
+    # Prepared messages with the same payload are interchangeable, which lets callers coalesce them.
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, PreparedMessage) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "PreparedMessage(%r)" % (self.data, )
+
+class BackendClient(BackendService.Client):
+    """
+    BackendService.Client that also accepts a PreparedMessage as data when sending messages.
+    """
+    def close(self):
+        self._iprot.trans.close()
+
+    def set_timeout(self, seconds):
+        self._iprot.trans.set_timeout(seconds)
+
+    def fileno(self):
+        return self._iprot.trans.fileno()
+
+    def read_reply(self):
+        """
+        read_reply() -> (method_name, message_type, seqid, value)
+
+        Reads the next reply, whatever call it is for. The value is that of the success field, or None if there
+        is none. For exception replies the value is the TApplicationException.
+        """
+        iprot = self._iprot
+        (fname, mtype, rseqid) = iprot.readMessageBegin()
+        if mtype == TMessageType.EXCEPTION:
+            error = TApplicationException()
+            error.read(iprot)
+            iprot.readMessageEnd()
+            return fname, mtype, rseqid, error
+
+        reply_type = getattr(BackendService, "%s_result" % fname, None)
+        if reply_type is None:
+            iprot.skip(TType.STRUCT)
+            iprot.readMessageEnd()
+            return fname, mtype, rseqid, None
+
+        reply = reply_type()
+        reply.read(iprot)
+        iprot.readMessageEnd()
+        return fname, mtype, rseqid, getattr(reply, 'success', None)
+
+    def send_sendUserMessage(self, sphere, userIds, data):
+        if isinstance(data, PreparedMessage):
+            self._send_prepared('sendUserMessage', sphere, userIds, data)
+        else:
+            BackendService.Client.send_sendUserMessage(self, sphere, userIds, data)
+
+    def send_sendChannelMessage(self, sphere, channels, data):
+        if isinstance(data, PreparedMessage):
+            self._send_prepared('sendChannelMessage', sphere, channels, data)
+        else:
+            BackendService.Client.send_sendChannelMessage(self, sphere, channels, data)
+
+    def _send_prepared(self, method_name, sphere, targets, message):
+        # Field 1 is the target list of both sendUserMessage_args and sendChannelMessage_args,
+        # the data and sphere fields that follow come already serialized from the message.
+        oprot = self._oprot
+        oprot.writeMessageBegin(method_name, TMessageType.CALL, self._seqid)
+        oprot.writeStructBegin('%s_args' % method_name)
+        if oprot.__class__ == TBinaryProtocolAccelerated and fastbinary is not None:
+            # Let fastbinary serialize the list, from arguments holding nothing but the targets. This gives
+            # the list field followed by the stop field, which is left out since the tail ends with one.
+            args_class = getattr(BackendService, '%s_args' % method_name)
+            args = args_class(None, targets, None)
+            oprot.trans.write(fastbinary.encode_binary(args, (args_class, args_class.thrift_spec))[:-1])
+        else:
+            oprot.writeFieldBegin('targets', TType.LIST, 1)
+            oprot.writeListBegin(TType.STRING, len(targets))
+            for target in targets:
+                oprot.writeString(target)
+            oprot.writeListEnd()
+            oprot.writeFieldEnd()
+        oprot.trans.write(message.tail(sphere))
+        oprot.writeStructEnd()
+        oprot.writeMessageEnd()
+        oprot.trans.flush()
@@ -0,0 +1,187 @@
+# coding=UTF-8
+"""
+Circuit breakers, keeping calls away from a Beaconpush node that is failing.
+
+A breaker is closed as long as the node behaves. It opens when too many of the
+calls in its sliding window failed, or were slow, and then rejects all calls
+for open_timeout seconds. After that it is half-open: a limited number of
+real calls are let through as probes, closing the breaker again when they
+succeed and reopening it when one of them fails.
+"""
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger("beaconpush.breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BUCKETS = 10 # Number of parts the window is divided in, it slides one part at a time
+
+class CircuitOpenError(Exception):
+    """Raised for calls rejected by an open circuit breaker."""
+
+class BreakerRegistry(object):
+    """
+    The circuit breakers of the nodes, one per node whichever pools the calls to it are made through.
+    """
+    def __init__(self, breaker=None):
+        """
+        @param breaker: Optional. Function creating the breaker of a node from its name. Defaults to CircuitBreaker
+        """
+        self.create_breaker = breaker or CircuitBreaker
+        self.breakers = {}
+
+    def get(self, addr):
+        """
+        get(addr) -> CircuitBreaker
+
+        @returns the breaker of the node at addr, (host, port)
+        """
+        breaker = self.breakers.get(addr)
+        if breaker is None:
+            breaker = self.breakers[addr] = self.create_breaker("%s:%d" % addr)
+
+        return breaker
+
+class CircuitBreaker(object):
+    def __init__(self, name, window=10.0, min_calls=20, error_rate=0.5, slow_call_duration=None, slow_call_rate=0.5,
+                 open_timeout=5.0, half_open_calls=1):
+        """
+        @param name: Name of the node, for logging
+        @param window: Optional. Seconds of calls the error and slow call rates are computed over. Defaults to 10.0
+        @param min_calls: Optional. Min number of calls in the window before the breaker may open. Defaults to 20
+        @param error_rate: Optional. Rate of failed calls in the window that opens the breaker. Defaults to 0.5
+        @param slow_call_duration: Optional. Seconds from which a call counts as slow, None to not count slow
+                                   calls. Defaults to None
+        @param slow_call_rate: Optional. Rate of slow calls in the window that opens the breaker. Defaults to 0.5
+        @param open_timeout: Optional. Seconds calls are rejected for once the breaker opened. Defaults to 5.0
+        @param half_open_calls: Optional. Number of probe calls let through at a time when half-open, and of
+                                successful ones needed to close the breaker. Defaults to 1
+        """
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self.listeners = [] # Functions called with (breaker, old_state, new_state) on every state change
+
+        self.state = CLOSED
+        self.opened_at = None
+        self.probes = 0 # Probe calls under way when half-open
+        self.probe_successes = 0
+        self._buckets = deque() # [bucket index, calls, failures, slow calls], oldest first
+        self.calls = 0 # Totals of the window
+        self.failures = 0
+        self.slow_calls = 0
+
+    def allow(self):
+        """
+        allow() -> bool
+
+        @returns whether a call may be made. Every allowed call must then be recorded.
+        """
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN:
+            if time.time() - self.opened_at < self.open_timeout:
+                return False
+
+            self.probes = 0
+            self.probe_successes = 0
+            self._set_state(HALF_OPEN)
+
+        if self.probes < self.half_open_calls:
+            self.probes += 1
+            return True
+
+        return False
+
+    def record(self, failed, duration):
+        """
+        Records the outcome of an allowed call.
+
+        @param failed: True if the call failed
+        @param duration: Seconds the call took
+        """
+        slow = self.slow_call_duration is not None and duration >= self.slow_call_duration
+
+        if self.state == HALF_OPEN:
+            self.probes = max(self.probes - 1, 0)
+            if failed or slow:
+                self._open()
+            else:
+                self.probe_successes += 1
+                if self.probe_successes >= self.half_open_calls:
+                    self._close()
+            return
+
+        if self.state == OPEN:
+            # Made before the breaker opened
+            return
+
+        bucket = self._slide(time.time())
+        bucket[1] += 1
+        self.calls += 1
+        if failed:
+            bucket[2] += 1
+            self.failures += 1
+        if slow:
+            bucket[3] += 1
+            self.slow_calls += 1
+
+        if self.calls >= self.min_calls and (self.failures >= self.error_rate * self.calls or
+                                             self.slow_calls >= self.slow_call_rate * self.calls):
+            self._open()
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        @returns a dict with the state, and the number of calls, failures and slow calls in the window.
+        """
+        self._slide(time.time())
+        return {"state": self.state, "calls": self.calls, "failures": self.failures, "slow_calls": self.slow_calls}
+
+    def _slide(self, now):
+        # Drops the buckets that fell out of the window, returns the current one
+        index = int(now * BUCKETS / self.window)
+        buckets = self._buckets
+        while buckets and buckets[0][0] <= index - BUCKETS:
+            expired, calls, failures, slow_calls = buckets.popleft()
+            self.calls -= calls
+            self.failures -= failures
+            self.slow_calls -= slow_calls
+
+        if not buckets or buckets[-1][0] != index:
+            buckets.append([index, 0, 0, 0])
+
+        return buckets[-1]
+
+    def _open(self):
+        self.opened_at = time.time()
+        self._set_state(OPEN)
+
+    def _close(self):
+        self._buckets.clear()
+        self.calls = self.failures = self.slow_calls = 0
+        self._set_state(CLOSED)
+
+    def _set_state(self, state):
+        old_state, self.state = self.state, state
+        if state == OPEN:
+            logger.warn("Circuit breaker of Beaconpush node %s opened, %d of the last %d calls failed and %d were slow." % (self.name, self.failures, self.calls, self.slow_calls))
+        else:
+            logger.info("Circuit breaker of Beaconpush node %s is %s." % (self.name, state))
+
+        for listener in self.listeners:
+            try:
+                listener(self, old_state, state)
+            except Exception:
+                logger.exception("Circuit breaker listener failed.")
@@ -1,8 +1,14 @@
 # coding=UTF-8
-import re, time, hmac, gevent, logging, hashlib
-from zlib import adler32
+import re, time, hmac, gevent, socket, logging, hashlib
+from itertools import izip, imap
+from gevent.select import select
 
-from beaconpush.socketpool import MultiHostSocketPool
+from beaconpush.socketpool import MultiHostSocketPool, MultiHostPipelinedPool, PipelinedConnection
+from beaconpush.outbox import Outbox, DROP_OLDEST
+from beaconpush.partitioner import Adler32Partitioner
+from beaconpush.routecache import RouteCache
+from beaconpush.backend import PreparedMessage
+from beaconpush.breaker import BreakerRegistry, CircuitOpenError
 
 logger = logging.getLogger("beaconpush.client")
 
@@ -45,70 +51,424 @@ class NoClientClient(object):
 
         return call
 
-client_pool = MultiHostSocketPool(connect_timeout=5)
+# A node has a single circuit breaker, whichever pool the calls to it go through
+breakers = BreakerRegistry()
+
+client_pool = MultiHostSocketPool(connect_timeout=5, breakers=breakers)
+pipelined_pool = MultiHostPipelinedPool(breakers=breakers)
+codec_client_pool = MultiHostSocketPool(connect_timeout=5, codec=True, breakers=breakers)
+codec_pipelined_pool = MultiHostPipelinedPool(codec=True, breakers=breakers)
+
+# The pools shared by the clients, {(pipelined, codec, max_lifetime, breaker): pool}
+pools = {
+    (False, False, None, None): client_pool,
+    (True, False, None, None): pipelined_pool,
+    (False, True, None, None): codec_client_pool,
+    (True, True, None, None): codec_pipelined_pool,
+}
+breaker_registries = {None: breakers} # {breaker: BreakerRegistry}
+
+def get_pool(pipelined=False, codec=False, max_lifetime=None, breaker=None):
+    """
+    get_pool(pipelined=False, codec=False, max_lifetime=None, breaker=None) -> MultiHostSocketPool or MultiHostPipelinedPool
+
+    @returns the pool shared by the clients created with these settings, see Client
+    """
+    if pipelined:
+        max_lifetime = None # A pipelined connection is never recycled
+
+    key = (pipelined, codec, max_lifetime, breaker)
+    pool = pools.get(key)
+    if pool is None:
+        registry = breaker_registries.get(breaker)
+        if registry is None:
+            registry = breaker_registries[breaker] = BreakerRegistry(breaker)
+
+        if pipelined:
+            pool = MultiHostPipelinedPool(codec=codec, breakers=registry)
+        else:
+            pool = MultiHostSocketPool(connect_timeout=5, codec=codec, max_lifetime=max_lifetime, breakers=registry)
+        pools[key] = pool
+
+    return pool
+
+class Call(object):
+    """
+    A call to a Beaconpush node. The request is sent when the call is created and the reply is read from the
+    socket when the call is waited for, so that calls to many nodes are made without a greenlet for each.
+
+    Has the same get(), wait(), ready() and successful() methods as a greenlet. Every call must be waited for,
+    which gives its socket back to the pool.
+
+    Calls are only made when the circuit breaker of the node allows them, and report their outcome to it.
+
+    Large requests are written by a greenlet of their own, so that a node that stops reading cannot hold up
+    the calls to the other nodes until their deadline has passed. Smaller ones fit in the socket buffers.
+    """
+    async_write_size = 65536 # Size in bytes of the messages and user IDs from which a request is written in the background
+
+    def __init__(self, pool, addr, method_name, args, deadline):
+        """
+        @param pool: The pool to take the connection from
+        @param addr: (host, port) of the Beaconpush node
+        @param method_name: Name of the BackendService method
+        @param args: Arguments of the method, including the operator
+        @param deadline: time.time() by which the reply must have been received
+        """
+        self.pool = pool
+        self.addr = addr
+        self.method_name = method_name
+        self.deadline = deadline
+        self.client = None
+        self.pending = None # (seqid, AsyncResult) when the connection is pipelined
+        self.value = None
+        self.exception = None
+        self.done = False
+        self.breaker = pool.get_breaker(addr)
+        self.started_at = None # Set once the breaker allowed the call
+        self.writer = None # Greenlet writing a large request
+
+        try:
+            if not self.breaker.allow():
+                raise CircuitOpenError("Beaconpush node %s:%s is unavailable, its circuit breaker is %s." % (addr + (self.breaker.state, )))
+
+            self.started_at = time.time()
+            self.client = pool.acquire_socket(addr, self._remaining())
+            if request_size(args) >= self.async_write_size:
+                self.writer = gevent.spawn(self._write_in_background, args)
+            else:
+                self._write(args)
+        except (Exception, gevent.Timeout), e:
+            self._finish(exception=self._translate(e))
+
+    def _write(self, args):
+        if isinstance(self.client, PipelinedConnection):
+            self.pending = self.client.send_request(self.method_name, *args, timeout=self._remaining())
+        else:
+            self.client.set_timeout(self._remaining())
+            getattr(self.client, "send_" + self.method_name)(*args)
+
+    def _write_in_background(self, args):
+        try:
+            self._write(args)
+        except (Exception, gevent.Timeout), e:
+            self._finish(exception=self._translate(e))
+
+    def wait(self):
+        """
+        Reads the reply, unless already done. Never raises.
+        """
+        if self.writer is not None:
+            # The write is bounded by the deadline of the call
+            self.writer.join()
+            self.writer = None
+
+        if self.done:
+            return
+
+        try:
+            if self.pending is not None:
+                seqid, result = self.pending
+                value = self.client.wait_reply(seqid, result, self._remaining())
+            else:
+                self.client.set_timeout(self._remaining())
+                value = getattr(self.client, "recv_" + self.method_name)()
+        except (Exception, gevent.Timeout), e:
+            self._finish(exception=self._translate(e))
+        else:
+            self._finish(value)
+
+    def get(self, block=True, timeout=None):
+        """
+        get(block=True, timeout=None) -> value
+
+        Waits for the reply and returns its value, or raises the error of the call. A timeout shortens the
+        deadline of the call.
+        """
+        if timeout is not None:
+            self.deadline = min(self.deadline, time.time() + timeout)
+
+        self.wait()
+        if self.exception is not None:
+            raise self.exception
+
+        return self.value
+
+    def ready(self):
+        return self.done
+
+    def successful(self):
+        return self.done and self.exception is None
+
+    def fileno(self):
+        """
+        fileno() -> int
+
+        @returns the file descriptor of the socket the reply comes in on, or None when the call is done, its
+                 request is being written in the background or its connection is pipelined.
+        """
+        if self.done or self.writer is not None or self.pending is not None:
+            return None
+
+        return self.client.fileno()
+
+    def _remaining(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise CallTimeout()
+
+        return remaining
+
+    def _translate(self, e):
+        if isinstance(e, (CallTimeout, socket.timeout, gevent.Timeout)):
+            return Exception("Beaconpush operation %s timed out" % self.method_name)
+
+        return e
+
+    def _finish(self, value=None, exception=None):
+        self.done = True
+        self.value = value
+        self.exception = exception
+        if self.started_at is not None:
+            self.breaker.record(exception is not None, time.time() - self.started_at)
+        if self.client is not None:
+            self.pool.release_socket(self.addr, self.client, failed=exception is not None)
+            self.client = None
+
+class CallTimeout(Exception):
+    """Raised by Call when its deadline has passed."""
+
+def request_size(args):
+    """
+    request_size(args) -> int
+
+    @returns the approximate size in bytes of the messages and user IDs or channel names in args.
+    """
+    size = 0
+    for arg in args:
+        if isinstance(arg, basestring):
+            size += len(arg)
+        elif isinstance(arg, PreparedMessage):
+            size += len(arg.data)
+        elif isinstance(arg, list):
+            size += sum(imap(len, arg))
+    return size
+
+class RetriedCall(object):
+    """
+    A call of an idempotent method, retried and hedged according to a RetryPolicy, see beaconpush.retry.
+    All attempts share the deadline of the call.
+
+    Hedged requests are only made on pooled connections, on a pipelined one the second request would queue
+    up behind the first. The losing attempt is left to a greenlet, which gives its socket back to the pool
+    once the reply came in.
+
+    Has the same interface as Call.
+    """
+    def __init__(self, pool, addr, method_name, args, deadline, policy):
+        self.pool = pool
+        self.addr = addr
+        self.method_name = method_name
+        self.args = args
+        self.deadline = deadline
+        self.policy = policy
+        self.value = None
+        self.exception = None
+        self.done = False
+        self.attempts = 1
+        self.hedged = False
+
+        policy.budget.deposit()
+        self.started_at = time.time()
+        self.call = Call(pool, addr, method_name, args, deadline)
+
+    def wait(self):
+        """
+        Waits for the reply, retrying on failures. Never raises.
+        """
+        if self.done:
+            return
+
+        policy = self.policy
+        call = self.call
+        while True:
+            call = self._hedge(call)
+            call.wait()
+            if call.successful():
+                policy.record_latency(self.method_name, time.time() - self.started_at)
+                break
+
+            if self.attempts >= policy.max_attempts or not policy.should_retry(call.exception):
+                break
+
+            delay = policy.backoff_delay(self.attempts)
+            if time.time() + delay >= self.deadline or not policy.budget.withdraw():
+                break
+
+            gevent.sleep(delay)
+            self.attempts += 1
+            policy.retries += 1
+            self.started_at = time.time()
+            call = Call(self.pool, self.addr, self.method_name, self.args, self.deadline)
+
+        self.call = call
+        self.done = True
+        self.value = call.value
+        self.exception = call.exception
+
+    def get(self, block=True, timeout=None):
+        """
+        get(block=True, timeout=None) -> value
+
+        See Call.get().
+        """
+        if timeout is not None:
+            self.deadline = min(self.deadline, time.time() + timeout)
+            self.call.deadline = min(self.call.deadline, self.deadline)
+
+        self.wait()
+        if self.exception is not None:
+            raise self.exception
+
+        return self.value
+
+    def ready(self):
+        return self.done
+
+    def successful(self):
+        return self.done and self.exception is None
+
+    def fileno(self):
+        """
+        fileno() -> int
+
+        @returns the file descriptor of the socket the reply of the first attempt comes in on, see Call.fileno.
+        """
+        if self.done:
+            return None
+
+        return self.call.fileno()
+
+    def _hedge(self, call):
+        """
+        _hedge(call) -> Call
+
+        Makes a hedged request when call has not replied within the hedge delay of the method.
+
+        @returns the call that replied first, or call when no hedged request was made.
+        """
+        delay = self.policy.hedge_delay(self.method_name)
+        fileno = call.fileno() if delay is not None else None
+        if fileno is None:
+            return call
+
+        remaining = self.deadline - time.time()
+        if remaining <= delay or select([fileno], [], [], delay)[0] or not self.policy.budget.withdraw():
+            return call
+
+        hedge = Call(self.pool, self.addr, self.method_name, self.args, self.deadline)
+        hedge_fileno = hedge.fileno()
+        if hedge_fileno is None:
+            # The hedged request failed right away
+            return call
+
+        self.hedged = True
+        self.policy.hedges += 1
+        readable = select([fileno, hedge_fileno], [], [], max(self.deadline - time.time(), 0))[0]
+        if readable and fileno not in readable:
+            call, hedge = hedge, call
+
+        gevent.spawn(hedge.wait)
+        return call
+
+def make_call(pool, addr, method_name, args, deadline, retry_policy=None):
+    """
+    make_call(pool, addr, method_name, args, deadline, retry_policy=None) -> Call
+
+    @returns a RetriedCall for the methods retry_policy applies to, a Call otherwise.
+    """
+    if retry_policy is not None and method_name in retry_policy.methods:
+        return RetriedCall(pool, addr, method_name, args, deadline, retry_policy)
+
+    return Call(pool, addr, method_name, args, deadline)
 
 class Invocation(object):
-    def __init__(self, host, port, operator, method_name):
+    timeout = 3 # Seconds a call may take, when not part of an operation with a deadline of its own
+
+    def __init__(self, host, port, operator, method_name, pool=client_pool, retry_policy=None):
         self.host = host
         self.port = port
         self.operator = operator
         self.method_name = method_name
+        self.pool = pool
+        self.retry_policy = retry_policy
 
     def __call__(self, *args, **kwargs):
-        def dispatch():
-            client = None
-            failed = False
-
-            wait_time = 3
-            timeout = gevent.Timeout(wait_time)
-            timeout.start()
+        """
+        Calls the method on the Beaconpush node, see Call and RetriedCall.
 
-            addr = (self.host, self.port)
-            try:
-                client = client_pool.acquire_socket(addr)
-                func = getattr(client, self.method_name)
-                return func(self.operator, *args, **kwargs)
-            except gevent.Timeout, t:
-                failed = True
-                raise Exception("Beaconpush operation %s timed out after %d seconds" % (self.method_name, wait_time))
-            except:
-                failed = True
-                raise
-            finally:
-                timeout.cancel()
-                client_pool.release_socket(addr, client, failed=failed)
-
-        return gevent.spawn(dispatch)
+        @param deadline: Optional keyword argument. time.time() by which the call must be done. Defaults to
+                         timeout seconds from now
+        """
+        deadline = kwargs.get("deadline") or time.time() + self.timeout
+        return make_call(self.pool, (self.host, self.port), self.method_name, (self.operator, ) + args, deadline,
+                         self.retry_policy)
 
 class ClientProxy(object):
-    def __init__(self, host, port, operator):
+    def __init__(self, host, port, operator, pool=client_pool, retry_policy=None):
         self._host = host
         self._port = port
         self._operator = operator
+        self._pool = pool
+        self._retry_policy = retry_policy
 
     def __getattribute__(self, name):
         if name[:1] == "_":
             return object.__getattribute__(self, name)
 
-        return Invocation(self._host, self._port, self._operator, name)
+        return Invocation(self._host, self._port, self._operator, name, self._pool, self._retry_policy)
 
 USER_ID_PATTERN = re.compile(r"^[a-zA-Z0-9._\-]{1,128}$")
+USER_IDS_PATTERN = re.compile(r"(?:[a-zA-Z0-9._\-]{1,128}\n)*\Z") # Newline separated user IDs, validated in one go
 CHANNEL_PATTERN = re.compile(r"^[#\*@]{1,2}[a-zA-Z0-9._\-]{1,128}$")
 CHANNEL_PREFIXES = set(["*", "#", "@"])
 
+# Result formats of get_users_online
+ONLINE_DICT = "dict" # {user_id: bool}
+ONLINE_SET = "set" # set of the user IDs online
+ONLINE_LIST = "list" # [bool], aligned with the user IDs asked for
+STRING_TYPE = frozenset([str])
+
 class Client(object):
     """
     Methods in this class are used to communicate with Beaconpush.
     """
     timeout = 10
+    call_timeout = 3 # Seconds an operation may take, all its calls to Beaconpush nodes included
     token_ttl = 4320
+    bulk_routing_threshold = 1000 # Number of user IDs from where they are routed in bulk, bypassing the route cache
+    max_ids_per_call = 10000 # Max number of user IDs sent to a node in a single call
     clients = []
+    hosts = []
     port = None
     operator = None
     sign_key = None
     encoder = None
-
-    def __init__(self, hosts, port=6052, operator="default", sign_key="BOGUS_KEY_REPLACE_THIS", encoder=None):
+    pool = None
+    outbox = None
+    partitioner = None
+    user_routes = None
+    channel_routes = None
+    handles = []
+    no_client = None
+    breaker_listeners = []
+    breaker_callbacks = None
+    retry_policy = None
+    presence_cache = None
+
+    def __init__(self, hosts, port=6052, operator="default", sign_key="BOGUS_KEY_REPLACE_THIS", encoder=None, pipelined=False,
+                 async_send=False, outbox_size=1000, outbox_overflow=DROP_OLDEST, outbox_workers=1, partitioner=None, route_cache_size=10000,
+                 codec=False, retry_policy=None, presence_cache=None, max_lifetime=None, breaker=None):
         """
         Creates a new Beaconpush Client instance
 
@@ -118,12 +478,57 @@ class Client(object):
         @param sign_key: Optional Beaconpush sign key. Defaults to "BOGUS_KEY_REPLACE_THIS"
         @param encoder: Optional message encoder, function used to encode messages before sending to Beaconpush server.
                         Should return string. Defaults to None
+        @param pipelined: Optional. If True, all calls to a Beaconpush node share a single connection where
+                          requests are pipelined and replies matched by sequence id, instead of each call
+                          checking out a connection of its own. Defaults to False
+        @param async_send: Optional. If True, send_to_users and send_to_channels return immediately and the messages
+                           are delivered by background greenlets. Defaults to False
+        @param outbox_size: Optional. Max number of messages queued per node in async mode. Defaults to 1000
+        @param outbox_overflow: Optional. What to do when the queue of a node is full in async mode, one of
+                                "drop_oldest", "drop_newest" or "block". Defaults to "drop_oldest"
+        @param outbox_workers: Optional. Number of greenlets delivering the messages queued for each node in async
+                               mode. With more than one, messages to a node may be delivered out of order.
+                               Defaults to 1
+        @param partitioner: Optional partitioner deciding which node a user or channel lives on, see
+                            beaconpush.partitioner. Must match the partitioning of the Beaconpush servers.
+                            Defaults to an Adler32Partitioner
+        @param route_cache_size: Optional. Max number of user IDs, and of channel names, whose node is remembered.
+                                 Defaults to 10000
+        @param codec: Optional. If True, calls are encoded and decoded by the hand-specialized codec in
+                      beaconpush.codec instead of the generated Thrift code. Defaults to False
+        @param retry_policy: Optional RetryPolicy retrying, and hedging, the read-only calls, see beaconpush.retry.
+                             Defaults to None, calls are not retried
+        @param presence_cache: Optional PresenceCache, see beaconpush.presence, caching the results of
+                               get_users_online. Pass it to the EventClient as well for it to be kept up to date
+                               by events. Defaults to None, no caching
+        @param max_lifetime: Optional. Seconds after which a connection is closed rather than reused, so that
+                             the connections of long-running processes are renewed over time. Not used when
+                             pipelined. Defaults to None, connections are kept for as long as they are used
+        @param breaker: Optional. Function creating the circuit breaker of a node from its name, to set its
+                        thresholds, e.g. functools.partial(CircuitBreaker, error_rate=0.2, slow_call_duration=1.0).
+                        The clients given the same function share the breakers of the nodes. Defaults to None,
+                        a CircuitBreaker with the default thresholds
         """
         self.clients = []
+        self.handles = [] # Stable per node wrappers of the clients, indexed like clients
+        self.no_client = NoClientClient()
+        self.breaker_listeners = []
+        self.breaker_callbacks = {} # {host: [callback registered with the breaker of the node]}
+        self.hosts = []
+        self.partitioner = partitioner or Adler32Partitioner()
+        self.user_routes = RouteCache(route_cache_size)
+        self.channel_routes = RouteCache(route_cache_size)
         self.port = port
         self.operator = operator
         self.sign_key = sign_key
         self.encoder = encoder
+        self.retry_policy = retry_policy
+        self.presence_cache = presence_cache
+        if presence_cache is not None and presence_cache.operator is None:
+            presence_cache.operator = operator
+        self.pool = get_pool(pipelined, codec, max_lifetime, breaker)
+        if async_send:
+            self.outbox = Outbox(outbox_size, outbox_overflow, workers=outbox_workers, timeout=self.timeout)
 
         if not type(hosts) == list:
             hosts = list(hosts)
@@ -139,16 +544,148 @@ class Client(object):
 
         @param host: Host to client
         """
-        self.clients.append(ClientProxy(host, self.port, self.operator))
+        client = ClientProxy(host, self.port, self.operator, self.pool, self.retry_policy)
+        self.clients.append(client)
+        self.handles.append(IgnoreErrorClient(client))
+        self.hosts.append(host)
+        for listener in self.breaker_listeners:
+            self._listen_to_breaker(host, listener)
+        self._set_nodes()
         logger.log(logging.DEBUG, "Beaconpush backend client added: %s" % host)
 
+    def remove_client(self, host):
+        """
+        remove_client(host)
+
+        Removes a client previously added
+
+        @param host: Host to client
+        """
+        index = self.hosts.index(host)
+        del self.clients[index]
+        del self.handles[index]
+        del self.hosts[index]
+        self._set_nodes()
+
+        listeners = self.pool.get_breaker((host, self.port)).listeners
+        for callback in self.breaker_callbacks.pop(host, []):
+            listeners.remove(callback)
+        logger.log(logging.DEBUG, "Beaconpush backend client removed: %s" % host)
+
+    def _set_nodes(self):
+        self.partitioner.set_nodes(self.hosts)
+
+        # Routes are only valid for the topology they were computed for
+        self.user_routes.clear()
+        self.channel_routes.clear()
+
+    def breaker_stats(self):
+        """
+        breaker_stats() -> dict
+
+        @returns the state of the circuit breaker of each node, {host: stats}, see CircuitBreaker.stats
+        """
+        return dict((host, self.pool.get_breaker((host, self.port)).stats()) for host in self.hosts)
+
+    def add_breaker_listener(self, listener):
+        """
+        add_breaker_listener(listener)
+
+        Registers a function called with (host, old_state, new_state) whenever the circuit breaker of a node
+        changes state, for all nodes current and to come.
+
+        @param listener: The function to call
+        """
+        self.breaker_listeners.append(listener)
+        for host in self.hosts:
+            self._listen_to_breaker(host, listener)
+
+    def _listen_to_breaker(self, host, listener):
+        callback = lambda breaker, old_state, new_state: listener(host, old_state, new_state)
+        self.pool.get_breaker((host, self.port)).listeners.append(callback)
+        self.breaker_callbacks.setdefault(host, []).append(callback)
+
+    def route_cache_stats(self):
+        """
+        route_cache_stats() -> dict
+
+        @returns hit/miss statistics of the route caches: {"users": stats, "channels": stats}
+        """
+        return {"users": self.user_routes.stats(), "channels": self.channel_routes.stats()}
+
+    def presence_cache_stats(self):
+        """
+        presence_cache_stats() -> dict
+
+        @returns the hit/miss statistics of the presence cache, see PresenceCache.stats, or None without one
+        """
+        if self.presence_cache is None:
+            return None
+
+        return self.presence_cache.stats()
+
+    def retry_stats(self):
+        """
+        retry_stats() -> dict
+
+        @returns the number of retries and of hedged requests made so far: {"retries": int, "hedges": int},
+                 or None without a retry policy
+        """
+        if self.retry_policy is None:
+            return None
+
+        return {"retries": self.retry_policy.retries, "hedges": self.retry_policy.hedges}
+
+    def warmup(self, min_idle=1):
+        """
+        warmup(min_idle=1) -> dict
+
+        Connects to all Beaconpush nodes ahead of time. Call it before the worker starts serving so that the
+        first calls don't pay for setting up connections.
+
+        @param min_idle: Optional. Number of idle connections opened, and kept from then on, per node. Defaults to 1
+        @returns {host: True/False} whether the node could be connected to
+        """
+        def warmup_host(host):
+            try:
+                self.pool.warmup((host, self.port), min_idle)
+                return True
+            except Exception, e:
+                logger.warn("Could not warm up connections to Beaconpush backend %s: %s" % (host, e))
+                return False
+
+        greenlets = [gevent.spawn(warmup_host, host) for host in self.hosts]
+        gevent.joinall(greenlets)
+        return dict((host, greenlet.value) for host, greenlet in izip(self.hosts, greenlets))
+
+    def prepare(self, message):
+        """
+        prepare(message) -> PreparedMessage
+
+        Encodes a message and serializes it for Thrift once. The result can be passed as message to any of the
+        send methods, any number of times, and only the targets are serialized for each call.
+
+        @param message: Arbitrary message to send.
+        @returns a PreparedMessage
+        """
+        if isinstance(message, PreparedMessage):
+            return message
+
+        return PreparedMessage(self._encode(message))
+
+    def _encode(self, message):
+        if isinstance(message, PreparedMessage) or self.encoder is None:
+            return message
+
+        return self.encoder(message)
+
     def send_to_users(self, message, user_ids):
         """
         send_to_users(message, user_ids)
 
         Sends a message to multiple users.
 
-        @param message: Arbitrary message to send.
+        @param message: Arbitrary message, or PreparedMessage, to send.
         @param user_ids: List of channel names as strings to receive the message.
         """
         if not type(user_ids) == list:
@@ -166,7 +703,7 @@ class Client(object):
 
         Send message to a multiple channels.
 
-        @param message: Arbitrary message to send.
+        @param message: Arbitrary message, or PreparedMessage, to send.
         @param channel_names: Tuple or list of channel names as strings to receive the message.
         """
         if not type(channel_names) == list:
@@ -180,27 +717,105 @@ class Client(object):
 
         self._send_message(message, channel_names)
 
+    def send_batch(self, batch, channels=False):
+        """
+        send_batch(batch, channels=False) -> [dict]
+
+        Sends many messages, each one to its own targets, using as few calls per Beaconpush node as possible.
+        All messages are routed up front and messages with the same payload headed for the same node are
+        coalesced into a single call. The calls to all nodes are then made in parallel.
+
+        @param batch: List of (message, targets) tuples, targets being a user ID or a list of user IDs.
+        @param channels: Optional. If True, targets are channel names instead of user IDs. Defaults to False
+        @returns a list with a dict per batch entry, mapping each target to True if it was delivered to its node(s)
+        """
+        method_name = "sendChannelMessage" if channels else "sendUserMessage"
+        calls = {} # {(client, message): [target]}
+        entry_routes = []
+
+        for message, targets in batch:
+            if not type(targets) == list:
+                targets = [targets]
+
+            message = self.prepare(message)
+
+            if channels:
+                for channel_name in targets:
+                    self._validate_channel_prefix(channel_name)
+                    self._verify_channel_name(channel_name)
+                routes = self._route_channels(targets)
+            else:
+                routes = self._route_users(targets)
+
+            for client, client_targets in routes.iteritems():
+                calls.setdefault((client, message), []).extend(client_targets)
+            entry_routes.append((message, routes))
+
+        deadline = self._deadline()
+        pending = {} # {(client, message): [call]}
+        for (client, message), targets in calls.iteritems():
+            chunks = [(client, targets)] if channels else self._chunk_routes({client: targets})
+            pending[(client, message)] = [getattr(client, method_name)(chunk, message, deadline=deadline) for client, chunk in chunks]
+
+        for chunks in pending.itervalues():
+            for call in chunks:
+                if call is not None:
+                    call.wait()
+
+        results = []
+        for message, routes in entry_routes:
+            delivered = {}
+            for client, client_targets in routes.iteritems():
+                successful = all(call is not None and call.successful() for call in pending[(client, message)])
+                for target in client_targets:
+                    # A target routed to several nodes (global channels) must be delivered to all of them
+                    delivered[target] = delivered.get(target, True) and successful
+            results.append(delivered)
+
+        return results
+
     def _send_message(self, message, channel_names):
-        greenlets = []
+        if self.outbox is None and len(channel_names) == 1 and self.handles and channel_names[0] and channel_names[0][0] != "*":
+            # A single node, the message is only serialized once anyway
+            index = self._get_channel_node_index(channel_names[0])
+            self._join_all([self._call_node(index, "sendChannelMessage", channel_names, self._encode(message))])
+            return
+
+        calls = []
         clients_and_channels = self._route_channels(channel_names) # {client, [channel_name]}
 
-        if self.encoder is not None:
-            message = self.encoder(message)
+        # Prepared once, global channels send the very same bytes to every node
+        message = self.prepare(message)
 
+        if self.outbox is not None:
+            for client, channel_names in clients_and_channels.iteritems():
+                self.outbox.put(client, "sendChannelMessage", channel_names, message)
+            return
+
+        deadline = self._deadline()
         for client, channel_names in clients_and_channels.iteritems():
-            greenlets.append(client.sendChannelMessage(channel_names, message))
+            calls.append(client.sendChannelMessage(channel_names, message, deadline=deadline))
 
-        self._join_all(greenlets)
+        self._join_all(calls)
 
     def _send_user_message(self, message, user_ids):
-        greenlets = []
+        if self.outbox is None and len(user_ids) == 1 and self.handles:
+            # A single node, the message is only serialized once anyway
+            index = self._get_user_route(user_ids[0])
+            self._join_all([self._call_node(index, "sendUserMessage", user_ids, self._encode(message))])
+            return
 
-        if self.encoder is not None:
-            message = self.encoder(message)
+        message = self.prepare(message)
 
-        clients = self._route_users(user_ids)
-        greenlets = [client.sendUserMessage(client_user_ids, message) for client, client_user_ids in clients.items()]
-        self._join_all(greenlets)
+        clients = self._chunk_routes(self._route_users(user_ids))
+        if self.outbox is not None:
+            for client, client_user_ids in clients:
+                self.outbox.put(client, "sendUserMessage", client_user_ids, message)
+            return
+
+        deadline = self._deadline()
+        calls = [client.sendUserMessage(client_user_ids, message, deadline=deadline) for client, client_user_ids in clients]
+        self._join_all(calls)
 
     def get_users_in_channel(self, channel_name):
         """
@@ -214,43 +829,128 @@ class Client(object):
         @returns A list of all user IDs in the specified channel
         """
 
-        clients = self._get_clients_for_channel(channel_name)
-        greenlets = [client.getUsersInChannel(channel_name) for client in clients]
-        self._join_all(greenlets)
+        if self.handles and channel_name and channel_name[0] != "*":
+            calls = [self._call_node(self._get_channel_node_index(channel_name), "getUsersInChannel", channel_name)]
+        else:
+            clients = self._get_clients_for_channel(channel_name)
+            deadline = self._deadline()
+            calls = [client.getUsersInChannel(channel_name, deadline=deadline) for client in clients]
+        self._join_all(calls)
 
         resultList = []
-        for greenlet in greenlets:
-            users = greenlet.get()
+        for call in calls:
+            users = call.get()
             if users is not None:
                 resultList += users
 
         return resultList
 
-    def get_users_online(self, user_ids):
+    def iter_users_in_channel(self, channel_name, dedupe=False):
+        """
+        iter_users_in_channel(channel_name, dedupe=False) -> iterator of string
+
+        Same as get_users_in_channel, but yields the users of each node as soon as its reply is in, instead of
+        building a single list of them all. Nodes whose call failed are logged and skipped.
+
+        @param channel_name: Channel name as string to get users for.
+        @param dedupe: Optional. If True, users connected to several nodes are yielded only once. This keeps
+                       a set of all the users yielded. Defaults to False
+
+        @returns an iterator of the user IDs in the specified channel
         """
-        get_users_online(user_ids) -> [string]
+        clients = self._get_clients_for_channel(channel_name)
+        deadline = self._deadline()
+        calls = [client.getUsersInChannel(channel_name, deadline=deadline) for client in clients]
+
+        seen = set() if dedupe else None
+        for call in self._iter_completed(calls):
+            if not call.successful():
+                logger.error("Result error: %s" % call.exception)
+                continue
+
+            users = call.value or ()
+            if seen is None:
+                for user_id in users:
+                    yield user_id
+            else:
+                for user_id in users:
+                    if user_id not in seen:
+                        seen.add(user_id)
+                        yield user_id
+
+    def get_users_online(self, user_ids, result_format=ONLINE_DICT):
+        """
+        get_users_online(user_ids, result_format=ONLINE_DICT) -> dict
 
         Query if selected users are online.
 
         @param user_ids: List of strings representing user IDs that consists of [a-zA-Z0-9._].
-        @returns a dict with a boolean mapping for each userId
+        @param result_format: Optional. ONLINE_DICT, ONLINE_SET or ONLINE_LIST. The set and the list are much
+                              cheaper to build for large numbers of user IDs. Defaults to ONLINE_DICT
+        @returns a dict with a boolean mapping for each userId, the set of the user IDs online, or a list of
+                 booleans in the order of user_ids, depending on result_format
         """
         if not type(user_ids) == list:
             user_ids = [user_ids]
 
-        clients = self._route_users(user_ids)
-        greenlets = [client.getUsersOnline(client_user_ids) for client, client_user_ids in clients.items()]
-        self._join_all(greenlets)
+        online = self._get_online_user_ids(user_ids)
+        if result_format == ONLINE_SET:
+            return online
 
-        result = dict((str(user_id), False) for user_id in user_ids)
-        for greenlet in greenlets:
-            users_online = greenlet.get()
-            if users_online:
-                for online_user in users_online:
-                    result[online_user] = True
+        # Most callers pass strings already, converting them all would cost more than checking
+        if not set(imap(type, user_ids)) <= STRING_TYPE:
+            user_ids = map(str, user_ids)
+
+        if result_format == ONLINE_LIST:
+            return map(online.__contains__, user_ids)
 
+        result = dict.fromkeys(user_ids, False)
+        result.update(dict.fromkeys(online, True))
         return result
 
+    def _get_online_user_ids(self, user_ids):
+        """
+        _get_online_user_ids(user_ids) -> set
+
+        @returns the set of the user IDs online, as strings. Users of failed calls are left out.
+        """
+        online = set()
+        cache = self.presence_cache
+        if cache is not None:
+            # Only the users not in the cache are asked for
+            query_ids = []
+            for user_id in user_ids:
+                is_online = cache.get(str(user_id))
+                if is_online is None:
+                    query_ids.append(user_id)
+                elif is_online:
+                    online.add(str(user_id))
+
+            if not query_ids:
+                return online
+            user_ids = query_ids
+
+        if len(user_ids) == 1 and self.handles:
+            calls = [self._call_node(self._get_user_route(user_ids[0]), "getUsersOnline", user_ids)]
+        else:
+            clients = self._chunk_routes(self._route_users(user_ids))
+            deadline = self._deadline()
+            calls = [client.getUsersOnline(client_user_ids, deadline=deadline) for client, client_user_ids in clients]
+        self._join_all(calls)
+
+        for call in calls:
+            users_online = call.get()
+            if users_online:
+                online.update(users_online)
+
+        # Users of failed calls are reported offline, they are not cached as such
+        if cache is not None and calls:
+            for user_id in user_ids:
+                user_id = str(user_id)
+                cache.put(user_id, user_id in online)
+
+        return online
+
     def get_num_users_online(self):
         """
         get_num_users_online() -> int
@@ -259,12 +959,13 @@ class Client(object):
 
         @returns Number of user IDs currently online.
         """
-        greenlets = [client.getNumUsersOnline() for client in self._get_clients()]
-        self._join_all(greenlets)
+        deadline = self._deadline()
+        calls = [client.getNumUsersOnline(deadline=deadline) for client in self._get_clients()]
+        self._join_all(calls)
 
         num_online = 0
-        for greenlet in greenlets:
-            num = greenlet.get()
+        for call in calls:
+            num = call.get()
             if num is not None:
                 num_online += num
 
@@ -279,8 +980,8 @@ class Client(object):
 
         @param user_id: User ID to query, a string representing a userId that consists of [a-zA-Z0-9._].
         """
-        for client in self._get_clients():
-            client.logout(user_id)
+        deadline = self._deadline()
+        self._join_all([client.logout(user_id, deadline=deadline) for client in self._get_clients()])
 
     def generate_token(self, token_id, remote=False):
         """
@@ -298,8 +999,10 @@ class Client(object):
         return "%s;%s" % (expire_time, signature)
 
     def _generate_token_remote(self, token_id):
-        client = self._get_client(token_id)
-        return client.generateToken(token_id).get()
+        if not self.handles:
+            return self._get_client(token_id).generateToken(token_id).get()
+
+        return self._call_node(self._get_channel_node_index(token_id), "generateToken", token_id).get()
 
     def _user_id_to_channel_name(self, user_id):
         user_id = str(user_id)
@@ -317,7 +1020,7 @@ class Client(object):
         @return the node index for the given user_id
         """
         try:
-            return adler32(str(user_id)) % len(self.clients)
+            return self.partitioner.get_node_index(str(user_id))
         except:
             return 0
 
@@ -340,28 +1043,58 @@ class Client(object):
             return [self._get_client(channel_name)]
 
     def _get_clients(self, error_return_value=None):
-        clients = []
-
         # If no Beaconpush client are connected return the NoClientClient
-        if not self.clients:
-            clients.append(NoClientClient(error_return_value))
-            return clients
+        if not self.handles:
+            return [self._get_no_client(error_return_value)]
 
-        for client in self.clients:
-            clients.append(IgnoreErrorClient(client, error_return_value))
+        if error_return_value is None:
+            return list(self.handles)
 
-        return clients
+        return [IgnoreErrorClient(client, error_return_value) for client in self.clients]
 
     def _get_client(self, user_id, error_return_value=None):
-        if not self.clients:
-            return NoClientClient(error_return_value)
+        if not self.handles:
+            return self._get_no_client(error_return_value)
 
-        client = self.clients[self._get_user_node_index(user_id)]
+        index = self._get_channel_node_index(user_id)
+        if error_return_value is None:
+            return self.handles[index]
 
-        if client in self.clients:
-            return IgnoreErrorClient(client, error_return_value)
-        else:
-            return NoClientClient(error_return_value)
+        return IgnoreErrorClient(self.clients[index], error_return_value)
+
+    def _get_no_client(self, error_return_value=None):
+        if error_return_value is None:
+            return self.no_client
+
+        return NoClientClient(error_return_value)
+
+    def _call_node(self, index, method_name, *args):
+        """
+        _call_node(index, method_name, *args) -> Call
+
+        Calls a single node right away in the calling greenlet, going straight to the pool instead of through
+        the per node proxies that are there for fanning out. Returns the call once it is done.
+        """
+        call = make_call(self.pool, (self.hosts[index], self.port), method_name, (self.operator, ) + args,
+                         self._deadline(), self.retry_policy)
+        call.wait()
+        return call
+
+    def _get_user_route(self, user_id):
+        index = self.user_routes.get(user_id)
+        if index is None:
+            index = self._get_user_node_index(self._user_id_to_channel_name(user_id))
+            self.user_routes.put(user_id, index)
+
+        return index
+
+    def _get_channel_node_index(self, channel_name):
+        index = self.channel_routes.get(channel_name)
+        if index is None:
+            index = self._get_user_node_index(channel_name)
+            self.channel_routes.put(channel_name, index)
+
+        return index
 
     def _route_channels(self, channel_names):
         """
@@ -373,14 +1106,19 @@ class Client(object):
 
         @returns a mapped dict: {client, [channels]}
         """
-        routes = {}
+        if not self.handles:
+            return {self.no_client: list(channel_names)}
+
+        buckets = [[] for handle in self.handles]
         for channel_name in channel_names:
-            clients = self._get_clients_for_channel(channel_name)
-            for client in clients:
-                channels_for_client = routes.get(client, [])
-                channels_for_client.append(channel_name)
-                routes[client] = channels_for_client
-        return routes
+            if not channel_name or channel_name[0] == "*":
+                # Channel name is empty or a global channel, which lives on all nodes
+                for bucket in buckets:
+                    bucket.append(channel_name)
+            else:
+                buckets[self._get_channel_node_index(channel_name)].append(channel_name)
+
+        return self._buckets_to_routes(buckets)
 
     def _route_users(self, user_ids):
         """
@@ -392,16 +1130,89 @@ class Client(object):
 
         @returns a mapped dict: {client, [user_ids]}
         """
-        routes = {}
+        if not self.handles:
+            for user_id in user_ids:
+                self._user_id_to_channel_name(user_id)
+            return {self.no_client: list(user_ids)}
+
+        if len(user_ids) >= self.bulk_routing_threshold:
+            return self._buckets_to_routes(self._route_user_indexes_bulk(user_ids))
+
+        return self._buckets_to_routes(self._route_user_indexes(user_ids))
+
+    def _route_user_indexes(self, user_ids):
+        """
+        _route_user_indexes(user_ids) -> [[user_id]]
+
+        Groups users by node index, without allocating anything but the per node lists.
+
+        @param user_ids: a list of user ids
+
+        @returns a list with the user ids of each node, indexed by node index
+        """
+        buckets = [[] for handle in self.handles]
+        cache = self.user_routes
+        young = cache.young
+        hits = 0
         for user_id in user_ids:
-            user_channel = self._user_id_to_channel_name(user_id)
-            clients = self._get_clients_for_channel(user_channel)
-            for client in clients:
-                user_ids_for_client = routes.get(client, [])
-                user_ids_for_client.append(user_id)
-                routes[client] = user_ids_for_client
+            # Only valid user IDs are cached, a hit skips both validation and hashing.
+            # The young generation of the cache is looked up inline since it serves the vast majority of hits.
+            index = young.get(user_id)
+            if index is None:
+                index = cache.get(user_id)
+                if index is None:
+                    index = self._get_user_node_index(self._user_id_to_channel_name(user_id))
+                    cache.put(user_id, index)
+                young = cache.young
+            else:
+                hits += 1
+
+            buckets[index].append(user_id)
+
+        cache.hits += hits
+        return buckets
+
+    def _route_user_indexes_bulk(self, user_ids):
+        """
+        _route_user_indexes_bulk(user_ids) -> [[user_id]]
+
+        Same as _route_user_indexes but for large lists of user ids. All ids are validated with a single regex
+        match and hashed in one batch by the partitioner, without going through the route cache.
+        """
+        keys = [str(user_id) for user_id in user_ids]
+        joined = "\n".join(keys) + "\n"
+        # An id containing a newline would otherwise pass as two valid ids
+        if joined.count("\n") != len(keys) or not USER_IDS_PATTERN.match(joined):
+            # Find the offending user id to report
+            for key in keys:
+                self._verify_user_id(key)
+
+        buckets = [[] for handle in self.handles]
+        appends = [bucket.append for bucket in buckets]
+        for user_id, index in izip(user_ids, self.partitioner.get_node_indexes(keys)):
+            appends[index](user_id)
+
+        return buckets
+
+    def _chunk_routes(self, routes):
+        """
+        _chunk_routes(routes) -> [(client, [user_id])]
+
+        Splits the user ids routed to each client into chunks of at most max_ids_per_call ids.
+        """
+        size = self.max_ids_per_call
+        chunks = []
+        for client, user_ids in routes.iteritems():
+            if len(user_ids) <= size:
+                chunks.append((client, user_ids))
+            else:
+                chunks.extend((client, user_ids[i:i + size]) for i in xrange(0, len(user_ids), size))
 
-        return routes
+        return chunks
+
+    def _buckets_to_routes(self, buckets):
+        handles = self.handles
+        return dict((handles[index], bucket) for index, bucket in enumerate(buckets) if bucket)
 
     def _validate_channel_prefix(self, channel_name):
         return
@@ -417,16 +1228,50 @@ class Client(object):
         if not CHANNEL_PATTERN.match(channel_name):
             raise Exception("Invalid channel name given: '%s'. Must be '%s'. See documentation for more info." % (channel_name, CHANNEL_PATTERN.pattern))
 
-    def _join_all(self, greenlets):
+    def _deadline(self):
+        return time.time() + self.call_timeout
+
+    def _iter_completed(self, calls):
         """
-        Waits for all greenlets or until the thriftTimeout has been reached.
+        _iter_completed(calls) -> iterator of Call
 
-        Note: No exception will be raised from this function. If an error occurs while joining a greenlet, or
-        the timeout is reached, the list of greenlets will be emptied. This is in order to ensure that iterating
-        the greenlets and calling their get() after this join will be perfectly safe.
+        Waits for the calls and yields them in the order their replies come in. Calls without a socket of their
+        own to watch, pipelined ones, are waited for in turn. Calls not yielded when the iteration stops are
+        still waited for, to give their sockets back.
         """
+        pending = [call for call in calls if call is not None]
         try:
-            gevent.joinall(greenlets, timeout=self.timeout, raise_error=True)
-        except:
-            logger.exception("Result error.")
-            del greenlets[:]
+            while pending:
+                ready = [call for call in pending if call.fileno() is None]
+                if not ready:
+                    filenos = [call.fileno() for call in pending]
+                    timeout = max(min(call.deadline for call in pending) - time.time(), 0)
+                    readable = select(filenos, [], [], timeout)[0]
+                    # Nothing readable by the deadline, waiting makes the calls time out
+                    ready = [call for call, fileno in izip(pending, filenos) if fileno in readable] or pending
+
+                for call in ready:
+                    pending.remove(call)
+                    call.wait()
+                    yield call
+        finally:
+            for call in pending:
+                call.wait()
+
+    def _join_all(self, calls):
+        """
+        Waits for all calls, each until the deadline of the operation has been reached.
+
+        Note: No exception will be raised from this function. If an error occurs in a call, or the deadline is
+        reached, the list of calls will be emptied. This is in order to ensure that iterating the calls and
+        calling their get() after this join will be perfectly safe.
+        """
+        for call in calls:
+            if call is not None:
+                call.wait()
+
+        for call in calls:
+            if call is None or not call.successful():
+                logger.error("Result error: %s" % (call.exception if call is not None else "no call made"))
+                del calls[:]
+                return
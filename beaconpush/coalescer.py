@@ -0,0 +1,136 @@
+# coding=UTF-8
+import time
+import gevent
+import logging
+from collections import deque
+from gevent.event import Event as Flag
+
+from beaconpush.presence import USER_CONNECTED, USER_DISCONNECTED
+
+logger = logging.getLogger("beaconpush.coalescer")
+
+COALESCED_EVENTS = frozenset([USER_CONNECTED, USER_DISCONNECTED])
+
+class EventCoalescer(object):
+    """
+    Collapses the connect and disconnect events of users flapping on and off a channel.
+
+    The first connect or disconnect event of a user on a channel is held for
+    window seconds, and so are the ones following it within the window. When the
+    window ends, only the net change is delivered: the last event if it is the
+    same as the first one, and nothing if the user ended up as before the first
+    one, connected then disconnected for instance. Other events are delivered
+    right away, by the caller.
+
+    The price is that every connect and disconnect event is delayed by the window.
+    """
+    def __init__(self, window, deliver):
+        """
+        @param window: Seconds events are held for
+        @param deliver: Function called with lists of events to deliver, from a greenlet of the coalescer for
+                        the events that were held
+        """
+        self.window = window
+        self.deliver = deliver
+        self.pending = {} # {(operator_id, user_id, channel): [first event, last event]}
+        self.deadlines = deque() # (time.time() by which to deliver, key), oldest first
+        self.not_empty = Flag()
+        self._flusher_task = None
+        self._delivering = False # Whether the flusher is delivering events
+
+        # Counters
+        self.received = 0
+        self.delivered = 0
+        self.collapsed = 0
+
+    def put(self, event):
+        """
+        put(event) -> bool
+
+        @returns True if the event is held, False if it is not one to coalesce and is up to the caller to deliver.
+        """
+        if event.name not in COALESCED_EVENTS:
+            return False
+
+        self.received += 1
+
+        key = (event.operator_id, event.user_id, event.channel)
+        entry = self.pending.get(key)
+        if entry is not None:
+            entry[1] = event
+            return True
+
+        self.pending[key] = [event, event]
+        self.deadlines.append((time.time() + self.window, key))
+        self.not_empty.set()
+        if self._flusher_task is None:
+            self._flusher_task = gevent.spawn(self._flusher)
+        return True
+
+    def flush(self, now=None):
+        """
+        Delivers the net change of the events held, those held until now or all of them.
+
+        @param now: Optional. time.time() until which events are delivered. Defaults to None, all of them
+        """
+        events = []
+        deadlines = self.deadlines
+        while deadlines and (now is None or deadlines[0][0] <= now):
+            deadline, key = deadlines.popleft()
+            first, last = self.pending.pop(key)
+            if last.name == first.name:
+                events.append(last)
+            else:
+                self.collapsed += 1
+
+        if not deadlines:
+            self.not_empty.clear()
+        if events:
+            self.delivered += len(events)
+            self.deliver(events)
+
+    def stop(self):
+        """
+        Delivers all the events held and stops the greenlet delivering them when their window ends. It is
+        started again by the next event put.
+        """
+        self.flush()
+        task, self._flusher_task = self._flusher_task, None
+        if task is not None and not self._delivering:
+            task.kill()
+        # Otherwise the flusher stops by itself once it has delivered its events
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        @returns a dict with the number of users and channels with events held, the number of connect and
+                 disconnect events received and delivered, and the number of collapsed sequences, which
+                 delivered nothing.
+        """
+        return {
+            "pending": len(self.pending),
+            "received": self.received,
+            "delivered": self.delivered,
+            "collapsed": self.collapsed,
+        }
+
+    def _flusher(self):
+        while self._flusher_task is gevent.getcurrent():
+            self.not_empty.wait()
+            try:
+                if not self.deadlines:
+                    # Flushed by flush() in the meantime
+                    self.not_empty.clear()
+                    continue
+
+                delay = self.deadlines[0][0] - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+
+                self._delivering = True
+                self.flush(time.time())
+            except Exception:
+                logger.exception("Delivering coalesced events failed.")
+            finally:
+                self._delivering = False
@@ -0,0 +1,238 @@
+# coding=UTF-8
+"""
+Hand-specialized codec for the seven BackendService calls.
+
+Builds each request frame, length prefix included, with struct into a single
+pre-sized buffer and parses replies straight from the frame, instead of going
+through the generic protocol and an _args/_result object per call. It speaks
+the strict binary protocol over framed transport, like the generated code.
+"""
+from struct import pack_into, unpack_from, calcsize
+from thrift.Thrift import TType, TMessageType, TApplicationException
+
+from beaconpush.backend import PreparedMessage
+
+VERSION_1 = -2147418112 # 0x80010000 as a signed 32-bit integer
+VERSION_MASK = -65536 # 0xffff0000 as a signed 32-bit integer
+
+# Argument fields of each call, in the order the generated code writes them:
+# (field id, field type, position of the argument in the method signature)
+REQUEST_FIELDS = {
+    'sendUserMessage': ((1, TType.LIST, 1), (2, TType.STRING, 2), (3, TType.STRING, 0)),
+    'sendChannelMessage': ((1, TType.LIST, 1), (2, TType.STRING, 2), (3, TType.STRING, 0)),
+    'getNumUsersOnline': ((1, TType.STRING, 0), ),
+    'getUsersOnline': ((1, TType.LIST, 1), (2, TType.STRING, 0)),
+    'logout': ((1, TType.STRING, 1), (2, TType.STRING, 0)),
+    'generateToken': ((1, TType.STRING, 1), (2, TType.STRING, 0)),
+    'getUsersInChannel': ((1, TType.STRING, 1), (2, TType.STRING, 0)),
+}
+
+FIELD_HEADER = calcsize('!bh')
+STRING_FIELD = calcsize('!bhi')
+LIST_FIELD = calcsize('!bhbi')
+
+class _ItemFormats(dict):
+    """struct format of a length prefixed string, by length of the string"""
+    def __missing__(self, length):
+        item_format = self[length] = 'i%ds' % length
+        return item_format
+
+ITEM_FORMATS = _ItemFormats()
+
+def _pack_strings(buf, offset, items):
+    """
+    Packs a list of length prefixed strings into buf, with a single pack_into call.
+    """
+    lengths = map(len, items)
+    values = [None] * (2 * len(items))
+    values[0::2] = lengths
+    values[1::2] = items
+    pack_into('!' + ''.join(map(ITEM_FORMATS.__getitem__, lengths)), buf, offset, *values)
+
+def encode_request(method_name, seqid, *args):
+    """
+    encode_request(method_name, seqid, *args) -> bytearray
+
+    Encodes a call of method_name, with the arguments of the BackendService.Client method of the same name,
+    into a complete frame ready to be written to the socket.
+    """
+    fields = REQUEST_FIELDS[method_name]
+
+    # Size everything up front so that the frame is built in one buffer
+    size = 4 + 4 + 4 + len(method_name) + 4 + 1 # Frame size, version, name, seqid, ... , stop
+    tail = None
+    for field_id, field_type, position in fields:
+        value = args[position]
+        if field_type == TType.LIST:
+            size += LIST_FIELD + 4 * len(value) + sum(map(len, value))
+        elif isinstance(value, PreparedMessage):
+            # The data field, with the sphere field and the stop after it, comes already serialized
+            tail = value.tail(args[0])
+            size += len(tail) - 1
+            break
+        else:
+            size += STRING_FIELD + len(value)
+
+    buf = bytearray(size)
+    pack_into('!iii%dsi' % len(method_name), buf, 0, size - 4, VERSION_1 | TMessageType.CALL, len(method_name), method_name, seqid)
+    offset = 16 + len(method_name)
+
+    for field_id, field_type, position in fields:
+        value = args[position]
+        if field_type == TType.LIST:
+            pack_into('!bhbi', buf, offset, TType.LIST, field_id, TType.STRING, len(value))
+            offset += LIST_FIELD
+            if value:
+                _pack_strings(buf, offset, value)
+                offset += 4 * len(value) + sum(map(len, value))
+        elif tail is not None and isinstance(value, PreparedMessage):
+            buf[offset:] = tail
+            return buf
+        else:
+            length = len(value)
+            pack_into('!bhi', buf, offset, TType.STRING, field_id, length)
+            buf[offset + STRING_FIELD:offset + STRING_FIELD + length] = value
+            offset += STRING_FIELD + length
+
+    # The stop field is already there, the buffer is zero filled
+    return buf
+
+def decode_reply(frame):
+    """
+    decode_reply(frame) -> (method_name, message_type, seqid, value)
+
+    Decodes a reply frame, without its length prefix, to any of the BackendService calls. The value is that of
+    the success field, or None if there is none. For exception replies the value is the TApplicationException.
+    """
+    version, = unpack_from('!i', frame, 0)
+    if version < 0:
+        if version & VERSION_MASK != VERSION_1:
+            raise TApplicationException(TApplicationException.INVALID_MESSAGE_TYPE, "Bad version in reply: %d" % version)
+        message_type = version & 0xff
+        length, = unpack_from('!i', frame, 4)
+        method_name = str(frame[8:8 + length])
+        seqid, = unpack_from('!i', frame, 8 + length)
+        offset = 12 + length
+    else:
+        # Non-strict message header, the first field is the length of the name
+        length = version
+        method_name = str(frame[4:4 + length])
+        message_type, seqid = unpack_from('!bi', frame, 4 + length)
+        offset = 9 + length
+
+    fields, offset = _decode_struct(frame, offset)
+    if message_type == TMessageType.EXCEPTION:
+        return method_name, message_type, seqid, TApplicationException(fields.get(2, TApplicationException.UNKNOWN), fields.get(1))
+
+    return method_name, message_type, seqid, fields.get(0)
+
+def _decode_struct(frame, offset):
+    fields = {}
+    while True:
+        field_type, = unpack_from('!b', frame, offset)
+        if field_type == TType.STOP:
+            return fields, offset + 1
+
+        field_id, = unpack_from('!h', frame, offset + 1)
+        fields[field_id], offset = _decode_value(frame, offset + FIELD_HEADER, field_type)
+
+def _decode_value(frame, offset, value_type):
+    if value_type == TType.STRING:
+        length, = unpack_from('!i', frame, offset)
+        return str(frame[offset + 4:offset + 4 + length]), offset + 4 + length
+    elif value_type == TType.I32:
+        return unpack_from('!i', frame, offset)[0], offset + 4
+    elif value_type in (TType.LIST, TType.SET):
+        element_type, size = unpack_from('!bi', frame, offset)
+        offset += 5
+        if element_type == TType.STRING:
+            # The only kind of list in the service, decoded without the generic dispatch
+            values = []
+            append = values.append
+            for i in xrange(size):
+                length, = unpack_from('!i', frame, offset)
+                append(str(frame[offset + 4:offset + 4 + length]))
+                offset += 4 + length
+            return values, offset
+
+        values = []
+        for i in xrange(size):
+            value, offset = _decode_value(frame, offset, element_type)
+            values.append(value)
+        return values, offset
+    elif value_type == TType.STRUCT:
+        return _decode_struct(frame, offset)
+    elif value_type == TType.MAP:
+        key_type, item_type, size = unpack_from('!bbi', frame, offset)
+        offset += 6
+        values = {}
+        for i in xrange(size):
+            key, offset = _decode_value(frame, offset, key_type)
+            values[key], offset = _decode_value(frame, offset, item_type)
+        return values, offset
+    elif value_type in FIXED_SIZE_FORMATS:
+        value_format = FIXED_SIZE_FORMATS[value_type]
+        return unpack_from(value_format, frame, offset)[0], offset + calcsize(value_format)
+
+    raise TApplicationException(TApplicationException.PROTOCOL_ERROR, "Unknown field type %d in reply" % value_type)
+
+FIXED_SIZE_FORMATS = {
+    TType.BOOL: '!?',
+    TType.BYTE: '!b',
+    TType.I16: '!h',
+    TType.I64: '!q',
+    TType.DOUBLE: '!d',
+}
+
+class CodecClient(object):
+    """
+    Drop-in replacement of BackendService.Client using the codec of this module. Reads and writes whole
+    frames on a beaconpush.transport.FramedSocketTransport.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self._seqid = 0
+
+    def close(self):
+        self.transport.close()
+
+    def set_timeout(self, seconds):
+        self.transport.set_timeout(seconds)
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def write_request(self, method_name, *args):
+        self.transport.write_frame(encode_request(method_name, self._seqid, *args))
+
+    def read_reply(self):
+        """
+        read_reply() -> (method_name, message_type, seqid, value)
+
+        Reads the next reply from the socket, see decode_reply.
+        """
+        return decode_reply(self.transport.read_frame())
+
+def _make_methods(method_name):
+    def send(self, *args):
+        self.write_request(method_name, *args)
+
+    def recv(self):
+        name, message_type, seqid, value = self.read_reply()
+        if message_type == TMessageType.EXCEPTION:
+            raise value
+        if value is None and method_name != 'logout':
+            raise TApplicationException(TApplicationException.MISSING_RESULT, "%s failed: unknown result" % method_name)
+        return value
+
+    def call(self, *args):
+        send(self, *args)
+        return recv(self)
+
+    return send, recv, call
+
+for _method_name in REQUEST_FIELDS:
+    _send, _recv, _call = _make_methods(_method_name)
+    setattr(CodecClient, 'send_' + _method_name, _send)
+    setattr(CodecClient, 'recv_' + _method_name, _recv)
+    setattr(CodecClient, _method_name, _call)
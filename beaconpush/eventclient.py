@@ -6,7 +6,16 @@ from gevent.greenlet import Greenlet
 import logging
 import random
 
+from beaconpush.eventqueue import EventQueue, BLOCK
+from beaconpush.coalescer import EventCoalescer
+
 class Event(object):
+    """
+    An event received from Beaconpush. Events are kept compact: no per instance dict, and the text form is
+    only built when asked for.
+    """
+    __slots__ = ("operator_id", "name", "user_id", "channel")
+
     def __init__(self, operator_id, name, user_id, channel):
         self.operator_id = operator_id
         self.name = name
@@ -23,15 +32,32 @@ class EventClient():
     host = None
     port = 6051
     max_event_size = 1000
+    read_size = 65536 # Max bytes read from the socket at a time
+    stop_timeout = 5 # Max seconds disconnect() waits for the queue workers to handle the events queued
     _spawn = Greenlet.spawn
 
-    def __init__(self, host, port=6051, handle=None, spawn=20):
-        if handle is None:
-            raise TypeError("'handle' must be provided")
+    def __init__(self, host, port=6051, handle=None, spawn=20, presence_cache=None, read_size=65536,
+                 handle_batch=None, batch_size=None, batch_delay=None, queue_size=None, overflow=BLOCK, workers=20,
+                 coalesce_window=None):
+        if handle is None and handle_batch is None:
+            raise TypeError("'handle' or 'handle_batch' must be provided")
 
         self.host = host
         self.port = port
         self.handle = handle
+        self.handle_batch = handle_batch # Called with lists of events instead of handle with each event
+        self.batch_size = batch_size # Max number of events per batch, None for no limit
+        self.batch_delay = batch_delay # Seconds events may wait for more to join their batch, None to not wait
+        self._batch = []
+        self._batch_timer = None
+        # With a queue_size, events are queued for a fixed number of worker greenlets instead of being spawned
+        self.queue = EventQueue(queue_size, overflow) if queue_size is not None else None
+        self.workers = workers
+        self._worker_tasks = []
+        # With a coalesce_window, the events of users flapping on and off channels are collapsed before delivery
+        self.coalescer = EventCoalescer(coalesce_window, self._deliver_coalesced) if coalesce_window is not None else None
+        self.presence_cache = presence_cache # PresenceCache updated from the events before they are handled
+        self.read_size = read_size
         self.set_spawn(spawn)
         self.sock = None
         self.logger = logging.getLogger("beaconpush.eventclient.%s:%d" % (host, port))
@@ -68,6 +94,9 @@ class EventClient():
 
             if not self._event_receiver_task:
                 self._event_receiver_task = gevent.spawn(self._event_receiver)
+            if self.queue is not None and not self._worker_tasks:
+                self.queue.open()
+                self._worker_tasks = [gevent.spawn(self._event_worker) for i in xrange(self.workers)]
             gevent.sleep() # Yield for our event receiver
         except socket.error as e:
             self.logger.error("Unable to connect. Reason: '%s'" % e)
@@ -75,14 +104,41 @@ class EventClient():
 
     def disconnect(self):
         self.disconnect_called = True
-        if not self.sock:
-            return
+        if self.sock:
+            self.logger.debug("Disconnecting...")
+            self.sock.close()
+            self.sock = None
 
-        self.logger.debug("Disconnecting...")
-        self.sock.close()
-        self.sock = None
+        # The events held are handed over before the workers are stopped, so that they are handled too
+        if self.coalescer is not None:
+            self.coalescer.stop()
+        self._flush_batch()
+        if self._worker_tasks:
+            self._stop_workers()
         self.logger.debug("Disconnected!")
 
+    def queue_stats(self):
+        """
+        queue_stats() -> dict
+
+        @returns the statistics of the event queue, see EventQueue.stats, or None without one
+        """
+        if self.queue is None:
+            return None
+
+        return self.queue.stats()
+
+    def coalescer_stats(self):
+        """
+        coalescer_stats() -> dict
+
+        @returns the statistics of the event coalescer, see EventCoalescer.stats, or None without one
+        """
+        if self.coalescer is None:
+            return None
+
+        return self.coalescer.stats()
+
     def reconnect(self):
         if self.disconnect_called:
             self.logger.debug("Skipping reconnect because disconnect() was explicitly called.")
@@ -97,13 +153,23 @@ class EventClient():
     def _event_receiver(self):
         self.logger.debug("Event receiver started.")
 
-        buffer = ""
+        # Data is received straight into buf, after the incomplete event left from the previous reads, if any.
+        # Only the bytes not scanned yet are searched for the end of the last complete event, and all complete
+        # events are then unframed with a single split.
+        buf = bytearray(2 * self.read_size)
+        end = 0 # Bytes in buf
+        scan = 0 # Offset from where buf has not been searched for a delimiter
         while self.sock:
+            if len(buf) - end < self.read_size:
+                # An incomplete event larger than read_size
+                buf.extend(bytearray(len(buf)))
+
             try:
-                data = self.sock.recv(1024)
-                if not data:
+                received = self.sock.recv_into(memoryview(buf)[end:], self.read_size)
+                if not received:
                     self.logger.warn("Unexpected disconnect.")
                     self.reconnect()
+                    end = scan = 0
                     continue
             except socket.timeout as e:
                 # A read timeout occurred, just try reading again
@@ -111,27 +177,116 @@ class EventClient():
             except socket.error as e:
                 self.logger.error("Error while reading socket. Reason: '%s'" % e)
                 self.reconnect()
+                end = scan = 0
                 continue
 
-            buffer += data
-            events = buffer.split("\r\n") # Unframe events from buffer
-            buffer = events.pop() # Put back any incomplete event, often an empty string
+            end += received
+            last = buf.rfind("\r\n", scan, end)
+            if last < 0:
+                scan = max(end - 1, 0) # The delimiter may start with the last byte
+                continue
+
+            events = str(buffer(buf, 0, last)).split("\r\n") # Unframe events from buf
+            rest = end - last - 2
+            if rest:
+                buf[:rest] = buf[last + 2:end] # Put back any incomplete event
+            end = rest
+            scan = max(end - 1, 0)
 
             for raw_event in events:
                 args = raw_event.split('\t')
                 if not len(args) == 4:
-                    self.logger.error("Received event has not 4 arguments. Event '%s'" % line)
+                    self.logger.error("Received event has not 4 arguments. Event '%s'" % raw_event)
+                    continue
 
-                e = Event(*args)
+                # Operator ids and event names are few, all events share the same strings
+                e = Event(intern(args[0]), intern(args[1]), args[2], args[3])
                 #self.logger.debug("Received %s" % e)
                 self._dispatch_event(e)
 
+            self._schedule_batch()
+
         self.logger.debug("Event receiver finished.")
         self._event_receiver_task = None
 
     def _dispatch_event(self, *args):
+        if self.presence_cache is not None:
+            self.presence_cache.handle_event(*args)
+
+        if self.coalescer is not None and self.coalescer.put(*args):
+            return
+
+        self._deliver_event(*args)
+
+    def _deliver_coalesced(self, events):
+        for event in events:
+            self._deliver_event(event)
+        self._schedule_batch()
+
+    def _deliver_event(self, *args):
+        if self.queue is not None:
+            self.queue.put(*args)
+            return
+
+        if self.handle_batch is not None:
+            self._batch.append(*args)
+            if self.batch_size is not None and len(self._batch) >= self.batch_size:
+                self._flush_batch()
+            return
+
         spawn = self._spawn
         if spawn is None:
             self.handle(*args)
         else:
-            spawn(self.handle, *args)
\ No newline at end of file
+            spawn(self.handle, *args)
+
+    def _event_worker(self):
+        # Handles the queued events, in batches of up to batch_size events with handle_batch
+        while True:
+            if self.handle_batch is not None:
+                events = self.queue.get(self.batch_size)
+            else:
+                events = self.queue.get()
+            if not events:
+                return # Closed by disconnect()
+
+            try:
+                if self.handle_batch is not None:
+                    self.handle_batch(events)
+                else:
+                    self.handle(events[0])
+            except Exception:
+                self.logger.exception("Event handler failed.")
+
+    def _stop_workers(self):
+        # Lets the workers handle the events queued, for up to stop_timeout seconds, then kills them
+        workers, self._worker_tasks = self._worker_tasks, []
+        self.queue.close()
+        gevent.joinall(workers, timeout=self.stop_timeout)
+        if not all(worker.dead for worker in workers):
+            self.logger.warn("Event workers did not finish in %s seconds, %d events not handled." % (self.stop_timeout, len(self.queue)))
+            gevent.killall(workers)
+
+    def _schedule_batch(self):
+        # Hands over the events batched so far, now or once batch_delay has passed
+        if self._batch:
+            if self.batch_delay is None:
+                self._flush_batch()
+            elif self._batch_timer is None:
+                self._batch_timer = gevent.spawn_later(self.batch_delay, self._batch_delay_expired)
+
+    def _batch_delay_expired(self):
+        # Flushes whatever is pending by now, possibly a batch started after the one the timer was for
+        self._batch_timer = None
+        self._flush_batch()
+
+    def _flush_batch(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        spawn = self._spawn
+        if spawn is None:
+            self.handle_batch(batch)
+        else:
+            spawn(self.handle_batch, batch)
\ No newline at end of file
@@ -0,0 +1,146 @@
+# coding=UTF-8
+from collections import deque
+from gevent.event import Event as Flag
+
+from beaconpush.outbox import DROP_OLDEST, DROP_NEWEST, BLOCK
+
+COALESCE = "coalesce"
+OVERFLOW_POLICIES = set([DROP_OLDEST, DROP_NEWEST, BLOCK, COALESCE])
+
+class EventQueue(object):
+    """
+    Bounded queue of events, between the EventClient reading them and the greenlets handling them.
+
+    When the queue is full the overflow policy decides what happens: block the
+    reader until there is room, which leaves the events in the socket buffers,
+    drop the oldest queued event, drop the new event, or coalesce. Coalescing
+    replaces the queued event of the same user and channel with the new one, as
+    only the latest state matters, and drops the oldest event when there is
+    none.
+    """
+    def __init__(self, size=10000, overflow=BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s'. Must be one of %s." % (overflow, ", ".join(sorted(OVERFLOW_POLICIES))))
+
+        self.size = size
+        self.overflow = overflow
+        self.events = deque() # Events, or [event] cells when coalescing so that they can be replaced in place
+        self.cells = {} if overflow == COALESCE else None # {(operator_id, user_id, channel): cell}
+        self.not_empty = Flag()
+        self.not_full = Flag()
+        self.not_full.set()
+        self.closed = False
+
+        # Counters
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def put(self, event):
+        """
+        Queues an event, see the overflow policies above.
+        """
+        self.received += 1
+        events = self.events
+        if len(events) >= self.size:
+            if self.overflow == BLOCK:
+                while len(events) >= self.size:
+                    self.not_full.wait()
+            elif self.overflow == DROP_NEWEST:
+                self.dropped += 1
+                return
+            elif self.overflow == COALESCE and self._coalesce(event):
+                return
+            else:
+                self._pop()
+                self.dropped += 1
+
+        if self.cells is None:
+            events.append(event)
+        else:
+            cell = [event]
+            events.append(cell)
+            self.cells[(event.operator_id, event.user_id, event.channel)] = cell
+
+        depth = len(events)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if depth >= self.size:
+            self.not_full.clear()
+        self.not_empty.set()
+
+    def get(self, max_events=1):
+        """
+        get(max_events=1) -> [Event]
+
+        Waits for events to be queued.
+
+        @param max_events: Optional. Max number of events taken, None to take them all. Defaults to 1
+        @returns a list of the oldest events, at least one unless the queue is closed and empty
+        """
+        events = self.events
+        while not events:
+            if self.closed:
+                return []
+            self.not_empty.wait()
+
+        count = len(events) if max_events is None else min(len(events), max_events)
+        batch = [self._pop() for i in xrange(count)]
+        if not events:
+            self.not_empty.clear()
+        self.not_full.set()
+        return batch
+
+    def close(self):
+        """
+        Closes the queue, get returns an empty list once the events queued are taken instead of waiting for more.
+        """
+        self.closed = True
+        self.not_empty.set()
+
+    def open(self):
+        """
+        Opens the queue again after close.
+        """
+        self.closed = False
+        if not self.events:
+            self.not_empty.clear()
+
+    def __len__(self):
+        return len(self.events)
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        @returns a dict with the number of events queued, the max number ever queued, and the number of events
+                 received, dropped and coalesced.
+        """
+        return {
+            "depth": len(self.events),
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def _pop(self):
+        if self.cells is None:
+            return self.events.popleft()
+
+        cell = self.events.popleft()
+        event = cell[0]
+        key = (event.operator_id, event.user_id, event.channel)
+        if self.cells.get(key) is cell:
+            del self.cells[key]
+        return event
+
+    def _coalesce(self, event):
+        cell = self.cells.get((event.operator_id, event.user_id, event.channel))
+        if cell is None:
+            return False
+
+        cell[0] = event
+        self.coalesced += 1
+        return True
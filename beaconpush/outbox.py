@@ -0,0 +1,101 @@
+# coding=UTF-8
+import gevent, logging
+from gevent import queue
+from Queue import Empty, Full
+
+logger = logging.getLogger("beaconpush.outbox")
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+OVERFLOW_POLICIES = set([DROP_OLDEST, DROP_NEWEST, BLOCK])
+
+class Outbox(object):
+    """
+    Bounded per-node queues of calls, drained by background greenlets.
+
+    Used by the Client in async mode so that sending never waits for the
+    Beaconpush server. When the queue of a node is full the overflow policy
+    decides what happens: drop the oldest queued call, drop the new call or
+    block the caller until there is room.
+
+    Each queue is drained by workers greenlets. With a single one, the default,
+    calls to a node are made in the order they were queued. With more, calls
+    are made concurrently and may reach the node out of order.
+    """
+    def __init__(self, size=1000, overflow=DROP_OLDEST, workers=1, timeout=10):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s'. Must be one of %s." % (overflow, ", ".join(sorted(OVERFLOW_POLICIES))))
+
+        self.size = size
+        self.overflow = overflow
+        self.workers = workers
+        self.timeout = timeout
+        self.queues = {} # {client: Queue}
+
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def put(self, client, method_name, *args):
+        """
+        put(client, method_name, *args)
+
+        Queues a call of method_name on client, to be made in the background.
+        """
+        calls = self.queues.get(client)
+        if calls is None:
+            calls = self._start(client)
+
+        call = (method_name, args)
+        if self.overflow == BLOCK:
+            calls.put(call)
+        elif self.overflow == DROP_NEWEST:
+            try:
+                calls.put_nowait(call)
+            except Full:
+                self.dropped += 1
+        else:
+            while True:
+                try:
+                    calls.put_nowait(call)
+                    break
+                except Full:
+                    try:
+                        calls.get_nowait()
+                        self.dropped += 1
+                    except Empty:
+                        pass
+
+    def pending(self):
+        """
+        pending() -> int
+
+        @returns Number of calls queued but not yet made, for all nodes.
+        """
+        return sum(calls.qsize() for calls in self.queues.itervalues())
+
+    def _start(self, client):
+        calls = queue.Queue(self.size)
+        self.queues[client] = calls
+        for i in xrange(self.workers):
+            gevent.spawn(self._drain, client, calls)
+
+        return calls
+
+    def _drain(self, client, calls):
+        while True:
+            method_name, args = calls.get()
+            try:
+                result = getattr(client, method_name)(*args)
+                if result is None:
+                    # The client could not even make the call
+                    self.failed += 1
+                    continue
+
+                result.get(timeout=self.timeout)
+                self.sent += 1
+            except (Exception, gevent.Timeout), e:
+                self.failed += 1
+                logger.debug("Background Beaconpush call %s failed: %s" % (method_name, e))
@@ -0,0 +1,157 @@
+# coding=UTF-8
+"""
+Partitioners decide which Beaconpush node a user ID or channel name lives on.
+
+The client and the Beaconpush servers must agree on the partitioning scheme,
+so only switch partitioner if the cluster is configured the same way.
+"""
+from bisect import bisect
+from zlib import adler32, crc32
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Adler32Partitioner(object):
+    """
+    The default partitioning scheme: adler32 of the key modulo the number of nodes.
+
+    Cheap, but changing the number of nodes moves nearly every key to another node.
+    """
+    def __init__(self):
+        self.num_nodes = 0
+
+    def set_nodes(self, hosts):
+        self.num_nodes = len(hosts)
+
+    def get_node_index(self, key):
+        return adler32(key) % self.num_nodes
+
+    def get_node_indexes(self, keys):
+        """
+        get_node_indexes(keys) -> [int]
+
+        Bulk version of get_node_index, vectorized with NumPy when available.
+        """
+        if numpy is not None and keys:
+            return (adler32_many(keys) % self.num_nodes).tolist()
+
+        num_nodes = self.num_nodes
+        return [adler32(key) % num_nodes for key in keys]
+
+class ConsistentHashPartitioner(object):
+    """
+    Consistent hashing on a ring with virtual nodes.
+
+    Each node is placed on the ring vnodes times (times its weight), a key belongs
+    to the first node found clockwise from the key's position. Adding or removing
+    a node only moves the keys of the affected ring segments, about 1/N of them.
+    """
+    def __init__(self, vnodes=160, weights=None):
+        """
+        @param vnodes: Optional. Number of points per node on the ring. Defaults to 160
+        @param weights: Optional. Dict of {host: weight}, hosts not in the dict have weight 1. Defaults to None
+        """
+        self.vnodes = vnodes
+        self.weights = weights or {}
+        self.ring_hashes = []
+        self.ring_nodes = []
+
+    def set_nodes(self, hosts):
+        ring = []
+        for index, host in enumerate(hosts):
+            for replica in xrange(int(self.vnodes * self.weights.get(host, 1))):
+                ring.append((self._hash("%s-%d" % (host, replica)), index))
+
+        ring.sort()
+        self.ring_hashes = [point for point, index in ring]
+        self.ring_nodes = [index for point, index in ring]
+
+    def get_node_index(self, key):
+        position = bisect(self.ring_hashes, self._hash(key))
+        if position == len(self.ring_hashes):
+            position = 0 # Wrap around the ring
+
+        return self.ring_nodes[position]
+
+    def get_node_indexes(self, keys):
+        return [self.get_node_index(key) for key in keys]
+
+    def _hash(self, key):
+        return crc32(key) & 0xffffffff
+
+def adler32_many(keys):
+    """
+    adler32_many(keys) -> numpy.ndarray
+
+    Computes zlib.adler32 of many non-empty strings at once with NumPy, giving the same
+    (signed) values as zlib.adler32 does.
+
+    For a key of bytes d_1..d_L, A = 1 + sum(d_i) and B = L + sum((L - i + 1) * d_i), both
+    modulo 65521. The sums of all keys are computed in one pass over the concatenated keys.
+    """
+    data = numpy.frombuffer("".join(keys), dtype=numpy.uint8).astype(numpy.int64)
+    lengths = numpy.fromiter((len(key) for key in keys), dtype=numpy.int64, count=len(keys))
+    starts = numpy.zeros(len(keys), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=starts[1:])
+
+    byte_sums = numpy.add.reduceat(data, starts)
+    weighted_sums = numpy.add.reduceat(data * numpy.arange(1, len(data) + 1, dtype=numpy.int64), starts)
+
+    a = (1 + byte_sums) % 65521
+    b = (lengths + (lengths + 1 + starts) * byte_sums - weighted_sums) % 65521
+    checksums = (b << 16) | a
+
+    # zlib.adler32 returns a signed 32-bit integer on Python 2
+    checksums[checksums >= 0x80000000] -= 0x100000000
+    return checksums
+
+def count_moved_keys(old_hosts, new_hosts, keys, partitioner=Adler32Partitioner):
+    """
+    count_moved_keys(old_hosts, new_hosts, keys, partitioner=Adler32Partitioner) -> int
+
+    Counts how many keys end up on another host when the cluster changes from old_hosts to new_hosts.
+
+    @param old_hosts: List of hosts before the change
+    @param new_hosts: List of hosts after the change
+    @param keys: List of keys (user IDs and/or channel names) as strings
+    @param partitioner: Optional. Function returning a new partitioner. Defaults to Adler32Partitioner
+    @returns the number of moved keys
+    """
+    before = partitioner()
+    before.set_nodes(old_hosts)
+    after = partitioner()
+    after.set_nodes(new_hosts)
+
+    moved = 0
+    for key in keys:
+        if old_hosts[before.get_node_index(key)] != new_hosts[after.get_node_index(key)]:
+            moved += 1
+
+    return moved
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] OLD_HOSTS NEW_HOSTS",
+                          description="Reports how many keys move when the cluster changes from OLD_HOSTS to "
+                                      "NEW_HOSTS, both comma separated lists of hosts.")
+    parser.add_option("-n", "--keys", type="int", default=100000, help="Number of synthetic user IDs to route")
+    parser.add_option("-c", "--consistent", action="store_true", default=False, help="Use consistent hashing")
+    parser.add_option("-v", "--vnodes", type="int", default=160, help="Virtual nodes per host when using consistent hashing")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("OLD_HOSTS and NEW_HOSTS are required")
+
+    old_hosts, new_hosts = args[0].split(","), args[1].split(",")
+    if options.consistent:
+        partitioner = lambda: ConsistentHashPartitioner(options.vnodes)
+    else:
+        partitioner = Adler32Partitioner
+
+    keys = ["user%d" % i for i in xrange(options.keys)]
+    moved = count_moved_keys(old_hosts, new_hosts, keys, partitioner)
+    print "%d of %d keys moved (%.1f%%)" % (moved, len(keys), 100.0 * moved / len(keys))
+
+if __name__ == '__main__':
+    main()
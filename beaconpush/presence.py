@@ -0,0 +1,86 @@
+# coding=UTF-8
+"""
+In-process cache of presence results, whether users are online, for Client.get_users_online.
+
+Results are cached for a short TTL, offline users included, so that pages
+asking for the same friend lists over and over don't go to Beaconpush every
+time. The cache can also be kept fresh by the events of an EventClient, see
+handle_event.
+"""
+import time
+
+from beaconpush.routecache import RouteCache
+
+USER_CONNECTED = "USER_CONNECTED_TO_CHANNEL"
+USER_DISCONNECTED = "USER_DISCONNECTED_TO_CHANNEL"
+
+class PresenceCache(RouteCache):
+    """
+    Bounded cache of user ID -> online, with entries expiring after a TTL. Evicts like RouteCache.
+    """
+    def __init__(self, size=10000, ttl=2.0, negative_ttl=None, operator=None):
+        """
+        @param size: Optional. Max number of users whose presence is cached. Defaults to 10000
+        @param ttl: Optional. Seconds online users are cached for. Defaults to 2.0
+        @param negative_ttl: Optional. Seconds offline users are cached for, 0 to not cache them. Defaults to ttl
+        @param operator: Optional. Operator the users are of, events of other operators are ignored. Defaults
+                         to None, set to the operator of the Client the cache is given to
+        """
+        RouteCache.__init__(self, size)
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.operator = operator
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """
+        get(user_id) -> bool
+
+        @returns whether the user is online, or None if not cached or expired.
+        """
+        entry = self.young.get(user_id)
+        if entry is None:
+            entry = self.old.pop(user_id, None)
+            if entry is not None:
+                RouteCache.put(self, user_id, entry)
+
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, online):
+        ttl = self.ttl if online else self.negative_ttl
+        if ttl > 0:
+            RouteCache.put(self, user_id, (time.time() + ttl, online))
+
+    def invalidate(self, user_id):
+        if self.young.pop(user_id, None) is not None or self.old.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def handle_event(self, event):
+        """
+        Updates the cache from an event of an EventClient. A user connecting is online, a user disconnecting
+        may still be connected to other channels and is looked up again.
+
+        @param event: The Event
+        """
+        if self.operator is not None and event.operator_id != self.operator:
+            return
+
+        if event.name == USER_CONNECTED:
+            self.put(event.user_id, True)
+        elif event.name == USER_DISCONNECTED:
+            self.invalidate(event.user_id)
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        @returns the stats of RouteCache.stats, and the number of entries invalidated by events.
+        """
+        stats = RouteCache.stats(self)
+        stats["invalidations"] = self.invalidations
+        return stats
@@ -0,0 +1,149 @@
+# coding=UTF-8
+"""
+Retries and hedged requests for the idempotent, read-only, BackendService calls.
+
+Failed calls are retried after a jittered exponential backoff, as long as the
+retry budget allows it, so that retries cannot multiply the load on a cluster
+that is already struggling. A hedged request is a second attempt made on
+another connection when the first one has not replied within a latency
+percentile of the method, whichever replies first is used.
+
+Calls sending messages are never retried nor hedged, it could deliver them twice.
+"""
+import time
+import random
+from thrift.Thrift import TApplicationException
+
+from beaconpush.breaker import CircuitOpenError
+
+IDEMPOTENT_METHODS = frozenset(["getUsersOnline", "getNumUsersOnline", "getUsersInChannel"])
+
+class RetryBudget(object):
+    """
+    Token bucket limiting retries, and hedges, to a ratio of the calls made. Every call deposits ratio of a
+    token and every retry withdraws a whole one. The bucket is also refilled with min_per_second tokens a
+    second, so that retries are possible while there is little traffic.
+    """
+    def __init__(self, ratio=0.1, min_per_second=10.0):
+        """
+        @param ratio: Optional. Retries allowed per call. Defaults to 0.1
+        @param min_per_second: Optional. Retries allowed per second whatever the number of calls. Defaults to 10.0
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max(min_per_second, 1.0)
+        self.balance = self.max_balance
+        self.updated_at = time.time()
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, self.max_balance)
+
+    def withdraw(self):
+        """
+        withdraw() -> bool
+
+        @returns True if a retry may be made, the token is then taken.
+        """
+        now = time.time()
+        self.balance = min(self.balance + (now - self.updated_at) * self.min_per_second, self.max_balance)
+        self.updated_at = now
+        if self.balance < 1:
+            return False
+
+        self.balance -= 1
+        return True
+
+class LatencyTracker(object):
+    """
+    Latencies of the most recent calls, for computing percentiles.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.samples = []
+        self.next_index = 0
+        self.sorted_samples = None
+        self.added = 0 # Samples added since sorted_samples was computed
+
+    def add(self, duration):
+        if len(self.samples) < self.size:
+            self.samples.append(duration)
+        else:
+            self.samples[self.next_index] = duration
+            self.next_index = (self.next_index + 1) % self.size
+        self.added += 1
+
+    def percentile(self, percent):
+        """
+        percentile(percent) -> float
+
+        @returns the latency below which percent of the samples are, or None if there are no samples.
+        """
+        if not self.samples:
+            return None
+
+        # Sorting is only redone once enough new samples came in
+        if self.sorted_samples is None or self.added * 8 >= len(self.samples):
+            self.sorted_samples = sorted(self.samples)
+            self.added = 0
+
+        index = min(int(len(self.sorted_samples) * percent / 100.0), len(self.sorted_samples) - 1)
+        return self.sorted_samples[index]
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=3, backoff=0.01, max_backoff=0.1, budget=None, hedge_percentile=None,
+                 min_hedge_samples=20, methods=IDEMPOTENT_METHODS):
+        """
+        @param max_attempts: Optional. Max number of attempts per call, the first one included. Defaults to 3
+        @param backoff: Optional. Seconds of the backoff before the first retry, doubled for each one after
+                        that. The actual delay is random, from 0 up to the backoff. Defaults to 0.01
+        @param max_backoff: Optional. Max seconds of backoff. Defaults to 0.1
+        @param budget: Optional. RetryBudget shared by all calls. Defaults to a RetryBudget()
+        @param hedge_percentile: Optional. Percentile of the latency of a method after which a hedged request is
+                                 made, 95 for instance. None to never hedge. Defaults to None
+        @param min_hedge_samples: Optional. Number of latencies of a method needed before hedging. Defaults to 20
+        @param methods: Optional. Names of the BackendService methods that are retried and hedged.
+                        Defaults to IDEMPOTENT_METHODS
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+        self.methods = methods
+        self.latencies = {} # {method name: LatencyTracker}
+        self.retries = 0
+        self.hedges = 0
+
+    def should_retry(self, exception):
+        # Rejected by the circuit breaker or failed on the server, a retry would fail the same way
+        return not isinstance(exception, (CircuitOpenError, TApplicationException))
+
+    def backoff_delay(self, attempt):
+        """
+        backoff_delay(attempt) -> float
+
+        @returns the seconds to wait before the retry following attempt number attempt (1 for the first one).
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** (attempt - 1))))
+
+    def record_latency(self, method_name, duration):
+        tracker = self.latencies.get(method_name)
+        if tracker is None:
+            tracker = self.latencies[method_name] = LatencyTracker()
+        tracker.add(duration)
+
+    def hedge_delay(self, method_name):
+        """
+        hedge_delay(method_name) -> float
+
+        @returns the seconds after which a hedged request is made, or None if no hedged request should be made.
+        """
+        if self.hedge_percentile is None:
+            return None
+
+        tracker = self.latencies.get(method_name)
+        if tracker is None or len(tracker.samples) < self.min_hedge_samples:
+            return None
+
+        return tracker.percentile(self.hedge_percentile)
@@ -0,0 +1,69 @@
+# coding=UTF-8
+
+class RouteCache(object):
+    """
+    Bounded cache of routing results, user ID or channel name -> node index.
+
+    Approximates LRU with two generations. Entries are added to the young
+    generation, and when it is full it replaces the old generation, evicting
+    everything that was not used since the previous turnover. A hit in the old
+    generation moves the entry back to the young one. Both lookups and inserts
+    are a couple of dict operations.
+    """
+    def __init__(self, size=10000):
+        """
+        @param size: Optional. Max number of entries kept. Defaults to 10000
+        """
+        self.generation_size = max(size // 2, 1)
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        get(key) -> int
+
+        @returns the cached node index for key, or None if not cached.
+        """
+        try:
+            value = self.young[key]
+        except KeyError:
+            try:
+                value = self.old.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.put(key, value)
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(self.young) >= self.generation_size:
+            self.old = self.young
+            self.young = {}
+
+        self.young[key] = value
+
+    def clear(self):
+        self.young = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def stats(self):
+        """
+        stats() -> dict
+
+        @returns a dict with the number of hits, misses, entries and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+        }
@@ -1,99 +1,194 @@
 # coding=UTF-8
-from gevent import socket
-from gevent import queue
+from gevent.event import AsyncResult
 import time, gevent, logging
-from Queue import Empty
-from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from collections import deque
+from thrift.Thrift import TMessageType, TApplicationException
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
 from thrift.transport import TSocket
-from thrift.transport.TTransport import TFramedTransport
 
-from beaconpush.generated_thrift import BackendService
+from beaconpush.backend import BackendClient
+from beaconpush.breaker import BreakerRegistry, CircuitBreaker, CLOSED
+from beaconpush.codec import CodecClient
+from beaconpush.transport import FramedSocketTransport
+
+try:
+    from gevent.lock import Semaphore
+except ImportError:
+    from gevent.coros import Semaphore
+
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
 
 logger = logging.getLogger("beaconpush.socketpool")
 
+# Use the C accelerated protocol when the thrift fastbinary extension is available
+ACCELERATED = fastbinary is not None
+_protocol_logged = False
+
+def create_protocol(transport):
+    """
+    create_protocol(transport) -> TBinaryProtocol
+
+    Wraps transport in the fastest binary protocol available. The accelerated protocol only decodes in C when
+    reading from a CReadableTransport, such as TFramedTransport.
+    """
+    global _protocol_logged
+    if not _protocol_logged:
+        _protocol_logged = True
+        if ACCELERATED:
+            logger.info("Using the accelerated Thrift protocol (fastbinary).")
+        else:
+            logger.info("Thrift fastbinary extension not available, using the pure Python Thrift protocol.")
+
+    if ACCELERATED:
+        return TBinaryProtocolAccelerated(transport)
+
+    return TBinaryProtocol(transport)
+
+def create_client(sock, codec=False):
+    """
+    create_client(sock, codec=False) -> BackendClient or CodecClient
+
+    Creates a client talking to the Beaconpush backend over sock, a TSocket. With codec, the client uses the
+    hand-specialized codec in beaconpush.codec rather than the generated Thrift code.
+    """
+    transport = FramedSocketTransport(sock)
+    if codec:
+        return CodecClient(transport)
+
+    return BackendClient(create_protocol(transport))
+
 class SocketPool(object):
-    def __init__(self, addr, max_sockets=40, idle_timeout=5.0, connect_timeout=10.0):
+    """
+    Pool of connections to a single Beaconpush node.
+
+    Free sockets are reused most recently released first, so that a burst is
+    served by warm connections and the excess left over from it stays idle long
+    enough to be disconnected. At least min_idle sockets are kept connected,
+    they are opened when the pool is created and reopened in the background.
+
+    Sockets connected for longer than max_lifetime are closed instead of being
+    reused, which spreads long-running workers' connections over time.
+
+    The circuit breaker of the node is kept by the pool, or taken from the
+    breakers shared with other pools, and consulted by the calls made through
+    it, see beaconpush.breaker.
+    """
+    reap_interval = 2.0 # Seconds between disconnecting idle sockets
+
+    def __init__(self, addr, max_sockets=40, idle_timeout=5.0, connect_timeout=10.0, min_idle=0, max_lifetime=None,
+                 codec=False, breaker=CircuitBreaker, breakers=None):
         self.addr = addr
+        self.codec = codec
         self.max_sockets = max_sockets
         self.idle_timeout = idle_timeout
+        self.min_idle = min(min_idle, max_sockets)
+        self.max_lifetime = max_lifetime
         self.connected_sockets = 0
-        self.free_sockets = queue.Queue()
+        self.free_sockets = deque() # (released_at, sock), the most recently released on the right
+        self.free_count = Semaphore(0) # Number of free sockets, waited on when there are none
+        self.connected_at = {}
         self.timeout = connect_timeout
-        self.last_release = {}
-        self.failed_state = False
+        self.breaker = breakers.get(addr) if breakers is not None else breaker("%s:%d" % addr)
+        self.logger = logging.getLogger("beaconpush.socketpool.%s:%d" % (addr))
+
         gevent.spawn(self.disconnect_idle_sockets_task)
-        gevent.spawn(self.check_failed_connections)
+        if self.min_idle:
+            gevent.spawn(self._keep_min_idle)
 
-        self.logger = logging.getLogger("beaconpush.socketpool.%s:%d" % (addr))
+    def warmup(self, min_idle=None):
+        """
+        warmup(min_idle=None) -> int
 
-    def check_failed_connections(self):
-        while True:
-            # We only process if we are in the failed state
-            gevent.sleep(5)
-            if not self.failed_state:
-                continue
+        Connects sockets until at least min_idle of them are idle in the pool. Raises if a connection fails.
 
-            # If we happen to be in faled stats, try making a connection to see if the service is up
-            try:
-                sock = socket.create_connection(self.addr, timeout=1)
-                sock.close()
-                self.failed_state = False
-            except:
-                pass
+        @param min_idle: Optional. Number of idle sockets, the pool keeps at least that many from now on.
+                         Defaults to the min_idle of the pool
+        @returns the number of idle sockets
+        """
+        if min_idle is not None:
+            self.min_idle = max(self.min_idle, min(min_idle, self.max_sockets))
+
+        while len(self.free_sockets) < self.min_idle and self.connected_sockets < self.max_sockets:
+            self.release_socket(self._connect_socket(self.timeout))
+
+        return len(self.free_sockets)
+
+    def _keep_min_idle(self):
+        if self.breaker.state != CLOSED:
+            return
+
+        try:
+            self.warmup()
+        except Exception, e:
+            self.logger.warn("Could not connect idle sockets: %s" % e)
 
     def disconnect_idle_sockets_task(self):
         while True:
-            gevent.sleep(2)
-
-            try:
-                sock = self.free_sockets.get_nowait()
-            except Empty:
-                continue
+            gevent.sleep(self.reap_interval)
+            self.disconnect_idle_sockets()
+            self._keep_min_idle()
 
-            released_at = self.last_release.get(sock, None)
-            if released_at and (time.time() - released_at) > self.idle_timeout:
-                self.release_socket(sock, idle=True)
-            else:
-                self.free_sockets.put_nowait(sock)
+    def disconnect_idle_sockets(self):
+        """
+        Disconnects every socket idle for longer than idle_timeout, keeping min_idle of them.
+        """
+        # The free sockets are ordered by release time, those idle for too long are all on the left
+        free = self.free_sockets
+        released_before = time.time() - self.idle_timeout
+        while len(free) > self.min_idle and free[0][0] < released_before and self.free_count.acquire(blocking=False):
+            released_at, sock = free.popleft()
+            self.release_socket(sock, idle=True)
 
     def _connect_socket(self, timeout=None):
-        if self.failed_state:
-            raise Exception("Unable to establish connection since server %s:%s is in failed state." % self.addr)
-
         self.connected_sockets += 1 # This must be done before creating connection to avoid races
         try:
             host, port = self.addr
 
             sock = TSocket.TSocket(host, port)
-            protocol = TBinaryProtocol(TFramedTransport(sock))
-            client = BackendService.Client(protocol)
+            if timeout is not None:
+                sock.setTimeout(timeout * 1000)
+            client = create_client(sock, self.codec)
             sock.open()
 
+            self.connected_at[client] = time.time()
             return client
         except:
             self.connected_sockets -= 1
-            self.failed_state = True
             raise
 
     def acquire_socket(self, timeout=None):
-        if self.free_sockets.empty() and self.connected_sockets < self.max_sockets:
-            sock = self._connect_socket(timeout)
-        else:
-            try:
-                sock = self.free_sockets.get(timeout=self.timeout)
-            except Exception, e:
-                self.logger.warn("Could not aquire socket, i waited for %s. Qsize: %s, Sockets: %s/%s." % (self.timeout, self.free_sockets.qsize(), self.connected_sockets, self.max_sockets))
-                raise
+        """
+        acquire_socket(timeout=None) -> client
 
-        return sock
+        @param timeout: Optional. Max number of seconds to wait for a free socket or for connecting one,
+                        capped by the connect_timeout of the pool. Defaults to connect_timeout
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
 
-    def release_socket(self, sock, failed=False, idle=False):
-        if failed or idle:
-            try:
-                del self.last_release[sock]
-            except KeyError:
-                pass
+        while True:
+            if not self.free_sockets and self.connected_sockets < self.max_sockets:
+                return self._connect_socket(timeout)
+
+            if not self.free_count.acquire(timeout=timeout):
+                self.logger.warn("Could not aquire socket, i waited for %s. Qsize: %s, Sockets: %s/%s." % (timeout, len(self.free_sockets), self.connected_sockets, self.max_sockets))
+                raise Exception("Could not acquire a connection to %s:%s within %s seconds." % (self.addr + (timeout, )))
+
+            released_at, sock = self.free_sockets.pop()
+            if not self._expired(sock):
+                return sock
 
+            self.release_socket(sock, expired=True)
+
+    def release_socket(self, sock, failed=False, idle=False, expired=False):
+        if not (failed or idle or expired):
+            expired = self._expired(sock)
+
+        if failed or idle or expired:
+            self.connected_at.pop(sock, None)
             self.connected_sockets -= 1
             try:
                 sock.close()
@@ -104,20 +199,238 @@ class SocketPool(object):
                 self.logger.critical("Exception occurred, disposing connection.")
             if idle:
                 self.logger.debug("Disconnected idle connection, %d sockets still connected" % (self.connected_sockets))
+            if expired:
+                self.logger.debug("Disconnected connection older than %s seconds, %d sockets still connected" % (self.max_lifetime, self.connected_sockets))
         else:
-            self.last_release[sock] = time.time()
-            self.free_sockets.put_nowait(sock)
+            self.free_sockets.append((time.time(), sock))
+            self.free_count.release()
+
+    def _expired(self, sock):
+        if self.max_lifetime is None:
+            return False
+
+        return (time.time() - self.connected_at.get(sock, time.time())) > self.max_lifetime
 
 class MultiHostSocketPool(SocketPool):
     def __init__(self, *args, **kwargs):
         self.create_pool = lambda addr: SocketPool(addr, *args, **kwargs)
         self.pools = {}
 
-    def acquire_socket(self, addr, timeout=10.0):
+    def get_pool(self, addr):
         if not addr in self.pools:
             self.pools[addr] = self.create_pool(addr)
 
-        return self.pools[addr].acquire_socket(timeout)
+        return self.pools[addr]
+
+    def acquire_socket(self, addr, timeout=10.0):
+        return self.get_pool(addr).acquire_socket(timeout)
+
+    def warmup(self, addr, min_idle=None):
+        """
+        warmup(addr, min_idle=None) -> int
+
+        See SocketPool.warmup, for the pool of addr.
+        """
+        return self.get_pool(addr).warmup(min_idle)
+
+    def get_breaker(self, addr):
+        return self.get_pool(addr).breaker
 
     def release_socket(self, addr, sock, failed=False):
         self.pools[addr].release_socket(sock, failed)
+
+
+class PipelinedConnection(object):
+    """
+    A single framed connection shared by any number of outstanding calls.
+
+    Requests are written back-to-back, each tagged with its own Thrift seqid, and
+    a reader greenlet matches the replies back to the waiting callers. The
+    object exposes the same methods as BackendService.Client.
+    """
+    def __init__(self, addr, codec=False):
+        self.addr = addr
+        self.codec = codec
+        self.pending = {} # {seqid: (method_name, AsyncResult)}
+        self.seqid = 0
+        self.closed = True
+        self.write_lock = Semaphore()
+        self.logger = logging.getLogger("beaconpush.socketpool.%s:%d" % (addr))
+
+    def open(self, timeout=None):
+        host, port = self.addr
+
+        self.sock = TSocket.TSocket(host, port)
+        if timeout is not None:
+            self.sock.setTimeout(timeout * 1000)
+        self.client = create_client(self.sock, self.codec)
+        self.sock.open()
+        self.sock.setTimeout(None) # The reader waits for replies for as long as it takes
+
+        self.closed = False
+        gevent.spawn(self._reply_reader)
+        self.logger.debug("Pipelined connection established.")
+
+    def close(self, reason=None):
+        if self.closed:
+            return
+
+        self.closed = True
+        try:
+            self.sock.close()
+        except:
+            pass
+
+        # Fail everyone still waiting for a reply on this connection
+        pending, self.pending = self.pending, {}
+        error = Exception("Beaconpush connection to %s:%s closed: %s" % (self.addr + (reason, )))
+        for method_name, result in pending.itervalues():
+            result.set_exception(error)
+
+    def __getattr__(self, name):
+        def call(*args):
+            return self._call(name, *args)
+
+        return call
+
+    def _next_seqid(self):
+        # Thrift seqids are signed 32-bit integers
+        self.seqid = (self.seqid + 1) & 0x7fffffff
+        return self.seqid
+
+    def _call(self, method_name, *args):
+        seqid, result = self.send_request(method_name, *args)
+        return self.wait_reply(seqid, result)
+
+    def send_request(self, method_name, *args, **kwargs):
+        """
+        send_request(method_name, *args, timeout=None) -> (seqid, AsyncResult)
+
+        Writes a request, the reply is to be waited for with wait_reply.
+
+        @param timeout: Optional keyword argument. Seconds the request may take to be written, waiting for the
+                        requests of the other callers included. Raises gevent.Timeout when exceeded. Defaults to
+                        None, no timeout
+        """
+        if self.closed:
+            raise Exception("Beaconpush connection to %s:%s is closed." % self.addr)
+
+        seqid = self._next_seqid()
+        result = AsyncResult()
+        self.pending[seqid] = (method_name, result)
+        timeout = gevent.Timeout(kwargs.get("timeout"))
+        timeout.start()
+        writing = False
+        try:
+            self.write_lock.acquire()
+            writing = True
+            self.client._seqid = seqid
+            getattr(self.client, "send_" + method_name)(*args)
+        except (Exception, gevent.Timeout), e:
+            self.pending.pop(seqid, None)
+            if writing:
+                # What was written of the request would corrupt the stream
+                self.close("write timed out" if isinstance(e, gevent.Timeout) else e)
+            raise
+        finally:
+            timeout.cancel()
+            if writing:
+                self.write_lock.release()
+
+        return seqid, result
+
+    def wait_reply(self, seqid, result, timeout=None):
+        """
+        wait_reply(seqid, result, timeout=None) -> value
+
+        Waits for the reply to a request written with send_request. Raises gevent.Timeout on timeout.
+        """
+        try:
+            return result.get(timeout=timeout)
+        finally:
+            # Covers timeouts, where the reply (if ever) will arrive for nobody
+            self.pending.pop(seqid, None)
+
+    def _reply_reader(self):
+        try:
+            while not self.closed:
+                fname, mtype, rseqid, value = self.client.read_reply()
+                method_name, result = self.pending.pop(rseqid, (None, None))
+                if result is None:
+                    # The caller has already given up (timed out)
+                    continue
+
+                if mtype == TMessageType.EXCEPTION:
+                    result.set_exception(value)
+                elif value is not None or fname == "logout":
+                    result.set(value)
+                else:
+                    result.set_exception(TApplicationException(TApplicationException.MISSING_RESULT, "%s failed: unknown result" % fname))
+        except Exception, e:
+            if not self.closed:
+                self.logger.warn("Pipelined connection failed: %s" % e)
+            self.close(e)
+
+class MultiHostPipelinedPool(object):
+    """
+    Keeps one PipelinedConnection, and one circuit breaker, per backend node. The breakers are taken from
+    breakers, a BreakerRegistry, when given.
+    Has the same interface as MultiHostSocketPool so that the two can be used
+    interchangeably.
+    """
+    def __init__(self, codec=False, breaker=CircuitBreaker, breakers=None):
+        self.codec = codec
+        self.breakers = breakers if breakers is not None else BreakerRegistry(breaker)
+        self.connections = {}
+        self.connect_locks = {}
+        self.failed_at = {}
+
+    def get_breaker(self, addr):
+        return self.breakers.get(addr)
+
+    def acquire_socket(self, addr, timeout=10.0):
+        conn = self.connections.get(addr)
+        if conn is not None and not conn.closed:
+            return conn
+
+        # Only one greenlet connects, the others wait for it and share the result
+        waiting_since = time.time()
+        lock = self.connect_locks.setdefault(addr, Semaphore())
+        lock.acquire()
+        try:
+            conn = self.connections.get(addr)
+            if conn is not None and not conn.closed:
+                return conn
+
+            failed_at = self.failed_at.get(addr)
+            if failed_at is not None and failed_at >= waiting_since:
+                # Failed while we were waiting for our turn, don't pile up connection attempts
+                raise Exception("Unable to connect to server %s:%s." % addr)
+
+            conn = PipelinedConnection(addr, self.codec)
+            try:
+                conn.open(timeout)
+            except:
+                self.failed_at[addr] = time.time()
+                raise
+
+            self.failed_at.pop(addr, None)
+            self.connections[addr] = conn
+            return conn
+        finally:
+            lock.release()
+
+    def warmup(self, addr, min_idle=None):
+        """
+        warmup(addr, min_idle=None) -> int
+
+        Opens the connection to addr ahead of the first call. min_idle is accepted for compatibility with
+        MultiHostSocketPool, a single connection serves all calls.
+        """
+        self.acquire_socket(addr)
+        return 1
+
+    def release_socket(self, addr, sock, failed=False):
+        # A failed call does not poison the connection since it is shared with other calls,
+        # the reply reader closes it as soon as the connection itself breaks.
+        pass
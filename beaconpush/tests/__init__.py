@@ -1,6 +1,12 @@
 import socket
 import gevent
+import gevent.event
 from gevent.server import StreamServer
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+from thrift.transport import TSocket
+from thrift.transport.TTransport import TFramedTransport, TTransportException
+
+from beaconpush.generated_thrift import BackendService
 
 def find_unused_port(family=socket.AF_INET, socktype=socket.SOCK_STREAM):
         """Copied from the gevent tests"""
@@ -54,6 +60,81 @@ class MockedEventServer(object):
     def send(self, raw_event):
         self.events_to_send.put_nowait(raw_event)
 
+class MockedBackendHandler(object):
+    """In-memory implementation of the Beaconpush backend service."""
+    def __init__(self):
+        self.user_messages = []
+        self.channel_messages = []
+        self.users_online = set()
+        self.channels = {}
+        self.logged_out = []
+        self.delay = 0
+
+    def sendUserMessage(self, sphere, userIds, data):
+        gevent.sleep(self.delay)
+        self.user_messages.append((sphere, userIds, data))
+        return len(userIds)
+
+    def sendChannelMessage(self, sphere, channels, data):
+        gevent.sleep(self.delay)
+        self.channel_messages.append((sphere, channels, data))
+        return len(channels)
+
+    def getNumUsersOnline(self, sphere):
+        return len(self.users_online)
+
+    def getUsersOnline(self, sphere, userIds):
+        return [user_id for user_id in userIds if user_id in self.users_online]
+
+    def logout(self, sphere, userId):
+        self.logged_out.append(userId)
+
+    def generateToken(self, sphere, userId):
+        return "token-%s" % userId
+
+    def getUsersInChannel(self, sphere, channelName):
+        return list(self.channels.get(channelName, []))
+
+class MockedBackendServer(object):
+    def start(self, host='127.0.0.1', port=None):
+        port = port or find_unused_port()
+        self.handler = MockedBackendHandler()
+        self.processor = BackendService.Processor(self.handler)
+        self.connections = 0
+        self.server = StreamServer((host, port), self._serve)
+        self.server.start()
+        return port
+
+    def stop(self):
+        self.server.stop()
+
+    def _serve(self, sock, address):
+        self.connections += 1
+        transport = TSocket.TSocket()
+        transport.setHandle(sock)
+        protocol = TBinaryProtocol(TFramedTransport(transport))
+        try:
+            while True:
+                self.processor.process(protocol, protocol)
+        except (TTransportException, socket.error):
+            pass
+
+class StalledServer(object):
+    """Accepts connections and never reads from them, like a hung Beaconpush node."""
+    def start(self, host='127.0.0.1', port=None):
+        port = port or find_unused_port()
+        self.stopped = gevent.event.Event()
+        self.server = StreamServer((host, port), self._hold)
+        self.server.start()
+        return port
+
+    def stop(self):
+        self.stopped.set()
+        self.server.stop()
+
+    def _hold(self, sock, address):
+        self.stopped.wait()
+
 def monkeypatch_teamcity_runner():
     try:
         import unittest
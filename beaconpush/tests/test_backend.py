@@ -0,0 +1,116 @@
+import unittest
+from struct import unpack
+from thrift.Thrift import TMessageType, TApplicationException
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from thrift.transport.TTransport import TMemoryBuffer
+
+from beaconpush import codec
+from beaconpush.backend import BackendClient, PreparedMessage
+from beaconpush.generated_thrift import BackendService
+
+USER_IDS = ["user%d" % i for i in xrange(100)]
+
+# Arguments of each call, in the order of the BackendService.Client methods
+CALLS = [
+    ("sendUserMessage", ("default", USER_IDS, '{"text": "hello"}')),
+    ("sendUserMessage", ("default", [], "")),
+    ("sendChannelMessage", ("default", ["#lobby", "*global"], "hello")),
+    ("getNumUsersOnline", ("default", )),
+    ("getUsersOnline", ("default", USER_IDS)),
+    ("logout", ("default", "hector")),
+    ("generateToken", ("default", "hector")),
+    ("getUsersInChannel", ("default", "*global")),
+]
+
+# Results of each call, as replied by the server
+RESULTS = [
+    ("sendUserMessage", 100),
+    ("getNumUsersOnline", 0),
+    ("getUsersOnline", USER_IDS),
+    ("getUsersOnline", []),
+    ("logout", None),
+    ("generateToken", "token"),
+    ("getUsersInChannel", ["hector", "elvis"]),
+]
+
+class RecordingBuffer(TMemoryBuffer):
+    """Keeps the written bytes around after flush."""
+    def flush(self):
+        pass
+
+class BackendClientTest(unittest.TestCase):
+    def written(self, client_class, method_name, *args, **kwargs):
+        buf = RecordingBuffer()
+        client = client_class(kwargs.get("protocol", TBinaryProtocol)(buf))
+        getattr(client, "send_" + method_name)(*args)
+        return buf.getvalue()
+
+    def test_prepared_message_is_wire_compatible(self):
+        message = PreparedMessage('{"text": "hello"}')
+        for protocol in (TBinaryProtocol, TBinaryProtocolAccelerated):
+            for method_name in ("sendUserMessage", "sendChannelMessage"):
+                for targets in ([], ["hector"], ["user%d" % i for i in xrange(100)]):
+                    self.assertEqual(self.written(BackendClient, method_name, "default", targets, message, protocol=protocol),
+                                     self.written(BackendService.Client, method_name, "default", targets, message.data))
+
+    def test_prepared_message_serialized_once(self):
+        message = PreparedMessage("hello")
+        self.assertTrue(message.tail("default") is message.tail("default"))
+        self.assertNotEqual(message.tail("default"), message.tail("other"))
+        self.assertEqual(message, PreparedMessage("hello"))
+        self.assertEqual(len(set([message, PreparedMessage("hello")])), 1)
+
+class CodecTest(unittest.TestCase):
+    """Validates the codec against the generated code."""
+    def generated_frame(self, method_name, args, seqid=0):
+        buf = RecordingBuffer()
+        client = BackendService.Client(TBinaryProtocol(buf))
+        client._seqid = seqid
+        getattr(client, "send_" + method_name)(*args)
+        return buf.getvalue()
+
+    def test_encode_request(self):
+        for method_name, args in CALLS:
+            frame = codec.encode_request(method_name, 42, *args)
+            size, = unpack("!i", str(frame[:4]))
+            self.assertEqual(size, len(frame) - 4)
+            self.assertEqual(str(frame[4:]), self.generated_frame(method_name, args, seqid=42))
+
+    def test_encode_prepared_request(self):
+        message = PreparedMessage("hello")
+        for method_name in ("sendUserMessage", "sendChannelMessage"):
+            self.assertEqual(codec.encode_request(method_name, 1, "default", USER_IDS, message),
+                             codec.encode_request(method_name, 1, "default", USER_IDS, "hello"))
+
+    def test_decode_reply(self):
+        for method_name, value in RESULTS:
+            buf = TMemoryBuffer()
+            protocol = TBinaryProtocol(buf)
+            protocol.writeMessageBegin(method_name, TMessageType.REPLY, 7)
+            getattr(BackendService, method_name + "_result")(*(() if value is None else (value, ))).write(protocol)
+            protocol.writeMessageEnd()
+
+            self.assertEqual(codec.decode_reply(buf.getvalue()), (method_name, TMessageType.REPLY, 7, value))
+
+    def test_decode_non_strict_reply(self):
+        buf = TMemoryBuffer()
+        protocol = TBinaryProtocol(buf, strictWrite=False)
+        protocol.writeMessageBegin("generateToken", TMessageType.REPLY, 7)
+        BackendService.generateToken_result("token").write(protocol)
+        protocol.writeMessageEnd()
+
+        self.assertEqual(codec.decode_reply(buf.getvalue()), ("generateToken", TMessageType.REPLY, 7, "token"))
+
+    def test_decode_exception(self):
+        buf = TMemoryBuffer()
+        protocol = TBinaryProtocol(buf)
+        protocol.writeMessageBegin("getUsersOnline", TMessageType.EXCEPTION, 7)
+        TApplicationException(TApplicationException.INTERNAL_ERROR, "boom").write(protocol)
+        protocol.writeMessageEnd()
+
+        method_name, message_type, seqid, error = codec.decode_reply(buf.getvalue())
+        self.assertEqual(message_type, TMessageType.EXCEPTION)
+        self.assertEqual((error.type, error.message), (TApplicationException.INTERNAL_ERROR, "boom"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+from gevent import monkey; monkey.patch_socket()
+import unittest
+import functools
+import gevent
+
+from beaconpush import Client
+from beaconpush.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from beaconpush.tests import MockedBackendServer
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("node", min_calls=4, error_rate=0.5, open_timeout=0.05, half_open_calls=2)
+        self.changes = []
+        self.breaker.listeners.append(lambda breaker, old_state, new_state: self.changes.append((old_state, new_state)))
+
+    def record(self, *outcomes):
+        for failed in outcomes:
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(failed, 0.01)
+
+    def test_stays_closed_below_min_calls(self):
+        self.record(True, True, True)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_stays_closed_below_error_rate(self):
+        self.record(False, False, False, True, False, True)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_opens(self):
+        self.record(False, True, False, True)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.changes, [(CLOSED, OPEN)])
+
+    def test_opens_on_slow_calls(self):
+        self.breaker.slow_call_duration = 0.5
+        for i in xrange(4):
+            self.breaker.record(False, 1.0)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_window_slides(self):
+        self.breaker.window = 0.05
+        self.record(True, True, True)
+        gevent.sleep(0.1)
+        self.record(True)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.stats()["calls"], 1)
+
+    def test_half_open_probes(self):
+        self.record(True, True, True, True)
+        gevent.sleep(0.06)
+
+        # Only half_open_calls probes at a time
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+        self.breaker.record(False, 0.01)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record(False, 0.01)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.stats()["calls"], 0)
+        self.assertEqual(self.changes, [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)])
+
+    def test_failed_probe_reopens(self):
+        self.record(True, True, True, True)
+        gevent.sleep(0.06)
+        self.record(True)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+class ClientBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockedBackendServer()
+        self.port = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_breaker(self):
+        c = Client(['127.0.0.1'], port=self.port, breaker=functools.partial(CircuitBreaker, min_calls=2, open_timeout=0.05))
+        breaker = c.pool.get_breaker(('127.0.0.1', self.port))
+        self.assertEqual((breaker.min_calls, breaker.open_timeout), (2, 0.05))
+        changes = []
+        c.add_breaker_listener(lambda host, old_state, new_state: changes.append((host, new_state)))
+
+        self.server.stop()
+        c.send_to_users("hello", ["hector"])
+        c.send_to_users("hello", ["hector"])
+        self.assertEqual(c.breaker_stats()['127.0.0.1']["state"], OPEN)
+        self.assertRaises(Exception, c.generate_token, "hector", remote=True)
+        self.assertEqual(breaker.stats()["calls"], 2) # Rejected without trying
+
+        # The node comes back, a real call probes it
+        self.server.start(port=self.port)
+        gevent.sleep(0.06)
+        self.assertEqual(c.generate_token("hector", remote=True), "token-hector")
+        self.assertEqual(changes, [('127.0.0.1', OPEN), ('127.0.0.1', HALF_OPEN), ('127.0.0.1', CLOSED)])
+
+    def test_breaker_shared_by_pools(self):
+        addr = ('127.0.0.1', self.port)
+        breaker = Client(['127.0.0.1'], port=self.port).pool.get_breaker(addr)
+        for options in ({"pipelined": True}, {"codec": True}, {"pipelined": True, "codec": True}, {"max_lifetime": 60}):
+            self.assertTrue(Client(['127.0.0.1'], port=self.port, **options).pool.get_breaker(addr) is breaker)
+
+        slow = functools.partial(CircuitBreaker, slow_call_duration=1.0)
+        own = Client(['127.0.0.1'], port=self.port, breaker=slow).pool.get_breaker(addr)
+        self.assertFalse(own is breaker)
+        self.assertEqual(own.slow_call_duration, 1.0)
+        self.assertTrue(Client(['127.0.0.1'], port=self.port, pipelined=True, breaker=slow).pool.get_breaker(addr) is own)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+from gevent import monkey; monkey.patch_socket()
+import time
+import logging
+import unittest
+import gevent
+
+from beaconpush import Client
+from beaconpush.client import ONLINE_SET, ONLINE_LIST
+from beaconpush.tests import MockedBackendServer, StalledServer
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockedBackendServer()
+        self.port = self.server.start()
+        self.handler = self.server.handler
+        self.c = Client(['127.0.0.1'], port=self.port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_send_to_users(self):
+        self.c.send_to_users("hello", ["hector", "elvis"])
+        self.assertEqual(self.handler.user_messages, [("default", ["hector", "elvis"], "hello")])
+
+    def test_send_to_channels(self):
+        self.c.send_to_channels("hello", ["#lobby"])
+        self.assertEqual(self.handler.channel_messages, [("default", ["#lobby"], "hello")])
+
+    def test_get_users_online(self):
+        self.handler.users_online.add("hector")
+        self.assertEqual(self.c.get_users_online(["hector", "elvis"]), {"hector": True, "elvis": False})
+
+    def test_get_users_online_formats(self):
+        self.handler.users_online.update(["hector", "frank"])
+        user_ids = ["elvis", "hector", "frank"]
+        self.assertEqual(self.c.get_users_online(user_ids, ONLINE_SET), set(["hector", "frank"]))
+        self.assertEqual(self.c.get_users_online(user_ids, ONLINE_LIST), [False, True, True])
+        self.assertEqual(self.c.get_users_online([u"hector", u"elvis"], ONLINE_LIST), [True, False])
+
+    def test_get_users_in_channel(self):
+        self.handler.channels["*global"] = ["hector", "elvis"]
+        self.assertEqual(self.c.get_users_in_channel("*global"), ["hector", "elvis"])
+
+    def test_iter_users_in_channel(self):
+        # Both nodes are served by the same server, and have the same users
+        server = MockedBackendServer()
+        port = server.start('0.0.0.0')
+        server.handler.channels["*global"] = ["hector", "elvis"]
+        server.handler.channels["#lobby"] = ["frank"]
+        try:
+            c = Client(['127.0.0.1', '127.0.0.2'], port=port)
+            self.assertEqual(sorted(c.iter_users_in_channel("*global")), ["elvis", "elvis", "hector", "hector"])
+            self.assertEqual(sorted(c.iter_users_in_channel("*global", dedupe=True)), ["elvis", "hector"])
+            self.assertEqual(list(c.iter_users_in_channel("#lobby")), ["frank"])
+
+            # Stopping early still gives all sockets back
+            users = c.iter_users_in_channel("*global")
+            users.next()
+            users.close()
+            for host in c.hosts:
+                self.assertEqual(c.pool.get_pool((host, port)).connected_sockets, 1)
+                self.assertEqual(len(c.pool.get_pool((host, port)).free_sockets), 1)
+        finally:
+            server.stop()
+
+    def test_get_num_users_online(self):
+        self.handler.users_online.update(["hector", "elvis"])
+        self.assertEqual(self.c.get_num_users_online(), 2)
+
+    def test_generate_token_remote(self):
+        self.assertEqual(self.c.generate_token("hector", remote=True), "token-hector")
+
+    def test_send_prepared(self):
+        c = Client(['127.0.0.1'], port=self.port, encoder=lambda message: "<%s>" % message)
+        message = c.prepare("hello")
+        c.send_to_users(message, ["hector"])
+        c.send_to_channels(message, ["*global"])
+        self.assertEqual(self.handler.user_messages, [("default", ["hector"], "<hello>")])
+        self.assertEqual(self.handler.channel_messages, [("default", ["*global"], "<hello>")])
+
+    def test_send_batch(self):
+        """Tests that messages with the same payload are coalesced into a single call per node."""
+        results = self.c.send_batch([("hello", ["hector"]), ("bye", "elvis"), ("hello", ["elvis", "frank"])])
+
+        self.assertEqual(results, [{"hector": True}, {"elvis": True}, {"elvis": True, "frank": True}])
+        self.assertEqual(sorted(self.handler.user_messages), [("default", ["elvis"], "bye"),
+                                                              ("default", ["hector", "elvis", "frank"], "hello")])
+
+    def test_send_batch_to_channels(self):
+        results = self.c.send_batch([("hello", ["#lobby", "*global"])], channels=True)
+        self.assertEqual(results, [{"#lobby": True, "*global": True}])
+        self.assertEqual(self.handler.channel_messages, [("default", ["#lobby", "*global"], "hello")])
+
+    def test_send_batch_failed(self):
+        self.server.stop()
+        c = Client(['127.0.0.1'], port=self.port)
+        self.assertEqual(c.send_batch([("hello", ["hector"])]), [{"hector": False}])
+
+    def test_async_send(self):
+        c = Client(['127.0.0.1'], port=self.port, async_send=True)
+        c.send_to_users("hello", ["hector"])
+        c.send_to_channels("hello", ["#lobby"])
+        self.assertEqual(self.handler.user_messages, []) # Nothing sent yet, we never waited
+
+        gevent.sleep(0.2)
+        self.assertEqual(self.handler.user_messages, [("default", ["hector"], "hello")])
+        self.assertEqual(self.handler.channel_messages, [("default", ["#lobby"], "hello")])
+        self.assertEqual(c.outbox.sent, 2)
+
+    def test_async_send_order(self):
+        c = Client(['127.0.0.1'], port=self.port, async_send=True)
+        messages = ["m%02d" % i for i in xrange(40)]
+        for message in messages:
+            c.send_to_users(message, ["hector"])
+
+        gevent.sleep(0.3)
+        self.assertEqual([data for sphere, user_ids, data in self.handler.user_messages], messages)
+
+    def test_async_send_overflow(self):
+        c = Client(['127.0.0.1'], port=self.port, async_send=True, outbox_size=1, outbox_overflow="drop_newest")
+        for i in xrange(10):
+            c.send_to_users("msg-%d" % i, ["hector"])
+        self.assertEqual(c.outbox.dropped, 9)
+
+        gevent.sleep(0.2)
+        self.assertEqual(self.handler.user_messages, [("default", ["hector"], "msg-0")])
+
+    def test_codec(self):
+        for pipelined in (False, True):
+            c = Client(['127.0.0.1'], port=self.port, codec=True, pipelined=pipelined)
+            self.handler.users_online.add("hector")
+            c.send_to_users("hello", ["hector"])
+            self.assertEqual(self.handler.user_messages[-1], ("default", ["hector"], "hello"))
+            self.assertEqual(c.get_users_online(["hector", "elvis"]), {"hector": True, "elvis": False})
+            self.assertEqual(c.generate_token("hector", remote=True), "token-hector")
+            c.logout("hector")
+            gevent.sleep(0.05)
+            self.assertEqual(self.handler.logged_out[-1], "hector")
+
+    def test_stalled_node(self):
+        """Tests that a node that stops reading does not hold up the calls to the other nodes."""
+        stalled = StalledServer()
+        stalled.start('127.0.0.2', self.port)
+        try:
+            c = Client(['127.0.0.2', '127.0.0.1'], port=self.port)
+            c.call_timeout = 1
+            c.send_to_channels("x" * (16 << 20), ["*global"])
+            self.assertEqual(len(self.handler.channel_messages), 1)
+        finally:
+            stalled.stop()
+
+    def test_pipelined_write_timeout(self):
+        stalled = StalledServer()
+        port = stalled.start()
+        try:
+            c = Client(['127.0.0.1'], port=port, pipelined=True)
+            c.call_timeout = 0.5
+            start = time.time()
+            c.send_to_channels("x" * (8 << 20), ["#lobby"])
+            self.assertTrue(time.time() - start < 1)
+
+            # The partly written request made the connection unusable
+            self.assertTrue(c.pool.connections[('127.0.0.1', port)].closed)
+        finally:
+            stalled.stop()
+
+    def test_deadline(self):
+        """Tests that an operation fails once its deadline has passed, for all its calls together."""
+        self.handler.delay = 0.5
+        for pipelined in (False, True):
+            c = Client(['127.0.0.1'], port=self.port, pipelined=pipelined)
+            c.call_timeout = 0.1
+            start = time.time()
+            self.assertEqual(c.send_batch([("hello", ["user%d" % i for i in xrange(10)])]), [dict(("user%d" % i, False) for i in xrange(10))])
+            self.assertTrue(time.time() - start < 0.3)
+            c.call_timeout = 3
+            self.assertEqual(c.generate_token("hector", remote=True), "token-hector")
+
+    def test_single_node_failed(self):
+        """Tests that single node operations, made inline, fail like the others."""
+        self.server.stop()
+        c = Client(['127.0.0.1'], port=self.port)
+        c.send_to_users("hello", ["hector"])
+        c.send_to_channels("hello", ["#lobby"])
+        self.assertEqual(c.get_users_online(["hector"]), {"hector": False})
+        self.assertEqual(c.get_users_in_channel("#lobby"), [])
+        self.assertRaises(Exception, c.generate_token, "hector", remote=True)
+
+    def test_call(self):
+        call = self.c.handles[0].generateToken("hector")
+        self.assertFalse(call.ready())
+        self.assertEqual(call.get(), "token-hector")
+        self.assertTrue(call.successful())
+
+    def test_pipelined(self):
+        """Tests that concurrent calls are pipelined over a single connection."""
+        self.handler.delay = 0.01
+        c = Client(['127.0.0.1'], port=self.port, pipelined=True)
+        greenlets = [gevent.spawn(c.send_to_users, "msg-%d" % i, ["user%d" % i]) for i in xrange(50)]
+        gevent.joinall(greenlets, timeout=5)
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sorted(data for sphere, user_ids, data in self.handler.user_messages),
+                         sorted("msg-%d" % i for i in xrange(50)))
+        self.assertEqual(c.generate_token("hector", remote=True), "token-hector")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import gevent
+
+from beaconpush.eventclient import Event
+from beaconpush.coalescer import EventCoalescer
+
+CONNECTED = "USER_CONNECTED_TO_CHANNEL"
+DISCONNECTED = "USER_DISCONNECTED_TO_CHANNEL"
+
+def event(user_id, name, channel=None):
+    return Event("default", name, user_id, channel or "@" + user_id)
+
+class EventCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.coalescer = EventCoalescer(0.05, self.delivered.extend)
+
+    def put(self, *events):
+        for e in events:
+            self.assertTrue(self.coalescer.put(e))
+
+    def names(self):
+        return [(e.user_id, e.name) for e in self.delivered]
+
+    def test_held_for_window(self):
+        self.put(event("hector", CONNECTED))
+        self.assertEqual(self.delivered, [])
+        gevent.sleep(0.08)
+        self.assertEqual(self.names(), [("hector", CONNECTED)])
+
+    def test_flapping_collapsed(self):
+        self.put(event("hector", CONNECTED), event("hector", DISCONNECTED), event("elvis", DISCONNECTED),
+                 event("elvis", CONNECTED), event("elvis", DISCONNECTED))
+        gevent.sleep(0.08)
+        self.assertEqual(self.names(), [("elvis", DISCONNECTED)])
+        self.assertEqual(self.coalescer.stats(), {"pending": 0, "received": 5, "delivered": 1, "collapsed": 1})
+
+    def test_keyed_on_channel(self):
+        self.put(event("hector", CONNECTED, "#lobby"), event("hector", DISCONNECTED, "@hector"))
+        self.coalescer.flush()
+        self.assertEqual(self.names(), [("hector", CONNECTED), ("hector", DISCONNECTED)])
+
+    def test_new_window_after_delivery(self):
+        self.put(event("hector", CONNECTED))
+        gevent.sleep(0.08)
+        self.put(event("hector", DISCONNECTED))
+        gevent.sleep(0.08)
+        self.assertEqual(self.names(), [("hector", CONNECTED), ("hector", DISCONNECTED)])
+
+    def test_flushed_before_flusher_runs(self):
+        self.put(event("hector", CONNECTED))
+        gevent.sleep(0.08) # The flusher is now waiting for events
+
+        # Flushed before the flusher woken by the event gets to run
+        self.put(event("elvis", CONNECTED))
+        self.coalescer.flush()
+        gevent.sleep(0)
+
+        self.put(event("frank", CONNECTED))
+        gevent.sleep(0.08)
+        self.assertEqual(self.names(), [("hector", CONNECTED), ("elvis", CONNECTED), ("frank", CONNECTED)])
+
+    def test_stop(self):
+        self.put(event("hector", CONNECTED))
+        flusher = self.coalescer._flusher_task
+        self.coalescer.stop()
+        self.assertEqual(self.names(), [("hector", CONNECTED)])
+        gevent.sleep(0)
+        self.assertTrue(flusher.dead)
+
+        self.put(event("elvis", CONNECTED))
+        gevent.sleep(0.08)
+        self.assertEqual(self.names(), [("hector", CONNECTED), ("elvis", CONNECTED)])
+
+    def test_other_events_not_held(self):
+        self.assertFalse(self.coalescer.put(event("hector", "USER_MESSAGE")))
+        self.assertEqual(self.coalescer.stats()["received"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,6 +49,111 @@ class EventClientTest(unittest.TestCase):
         for i in xrange(5000):
             self.assertEqual(str(self.events.get(timeout=10)), str(EVENT_1))
 
+    def test_events_split_across_reads(self):
+        self.c = EventClient('127.0.0.1', port=self.port, handle=lambda e: self.events.put_nowait(e), read_size=16)
+        self.c.connect()
+        raw = str(EVENT_1) + str(EVENT_2)
+        for piece in (raw[:10], raw[10:len(str(EVENT_1)) - 1], raw[len(str(EVENT_1)) - 1:-5], raw[-5:]):
+            self.event_server.send(piece)
+            gevent.sleep(0.01)
+        self.assertReceived(EVENT_1, 0.2)
+        self.assertReceived(EVENT_2, 0.2)
+
+    def test_events_compact(self):
+        self.c.connect()
+        self.send(EVENT_1)
+        self.send(EVENT_1)
+        first, second = self.events.get(timeout=0.2), self.events.get(timeout=0.2)
+        self.assertFalse(hasattr(first, "__dict__"))
+        self.assertTrue(first.operator_id is second.operator_id and first.name is second.name)
+        self.assertEqual(str(first), str(EVENT_1))
+
+    def test_malformed_event_skipped(self):
+        self.c.connect()
+        self.event_server.send("garbage\r\n")
+        self.send(EVENT_1)
+        self.assertReceived(EVENT_1, 0.2)
+
+    def test_handle_batch(self):
+        batches = []
+        self.c = EventClient('127.0.0.1', port=self.port, handle_batch=batches.append, batch_size=100)
+        self.c.connect()
+        for i in xrange(1000):
+            self.event_server.send(str(EVENT_1))
+        gevent.sleep(0.2)
+
+        self.assertEqual(sum(len(batch) for batch in batches), 1000)
+        self.assertTrue(10 <= len(batches) < 1000)
+        self.assertTrue(all(len(batch) <= 100 for batch in batches))
+        self.assertEqual(str(batches[0][0]), str(EVENT_1))
+
+    def test_handle_batch_delay(self):
+        batches = []
+        self.c = EventClient('127.0.0.1', port=self.port, handle_batch=batches.append, batch_delay=0.1, spawn=None)
+        self.c.connect()
+        for event in (EVENT_1, EVENT_2, EVENT_3):
+            self.send(event)
+            gevent.sleep(0.02)
+        self.assertEqual(batches, [])
+
+        gevent.sleep(0.1)
+        self.assertEqual([[str(e) for e in batch] for batch in batches], [[str(EVENT_1), str(EVENT_2), str(EVENT_3)]])
+
+    def test_queue(self):
+        self.c = EventClient('127.0.0.1', port=self.port, handle=self.slow_handler, queue_size=2, overflow="drop_newest",
+                             workers=1)
+        self.c.connect()
+        self.send(EVENT_1)
+        gevent.sleep(0.05) # Taken by the worker
+        self.send(EVENT_2)
+        self.send(EVENT_3)
+        gevent.sleep(0.05)
+        self.send(EVENT_1) # The queue is full
+        self.assertReceived(EVENT_1, 1)
+        self.assertReceived(EVENT_2, 1)
+        self.assertReceived(EVENT_3, 1)
+        stats = self.c.queue_stats()
+        self.assertEqual((stats["received"], stats["dropped"], stats["max_depth"]), (4, 1, 2))
+
+    def test_queue_workers_stopped(self):
+        self.c = EventClient('127.0.0.1', port=self.port, handle=lambda e: None, queue_size=10, workers=2)
+        self.c.connect()
+        workers = self.c._worker_tasks
+        self.assertEqual(len(workers), 2)
+        self.c.disconnect()
+        gevent.sleep(0)
+        self.assertTrue(all(worker.dead for worker in workers))
+        self.assertEqual(self.c._worker_tasks, [])
+
+    def test_disconnect_handles_queued_events(self):
+        self.c = EventClient('127.0.0.1', port=self.port, handle=self.slow_handler, queue_size=1, workers=1,
+                             coalesce_window=5)
+        self.c.connect()
+        self.send(EVENT_1) # Held by the coalescer
+        message_1 = Event('default', 'USER_MESSAGE', 'hector', '@hector')
+        message_2 = Event('default', 'USER_MESSAGE', 'elvis', '@elvis')
+        self.send(message_1) # Taken by the worker
+        self.send(message_2) # The queue is full
+        gevent.sleep(0.05)
+        workers = self.c._worker_tasks
+        with gevent.Timeout(5):
+            self.c.disconnect()
+
+        self.assertTrue(all(worker.dead for worker in workers))
+        self.assertTrue(self.c.coalescer._flusher_task is None)
+        self.assertEqual([str(self.events.get_nowait()) for i in xrange(3)], [str(message_1), str(message_2), str(EVENT_1)])
+
+    def test_coalesce(self):
+        self.c = EventClient('127.0.0.1', port=self.port, handle=lambda e: self.events.put_nowait(e), coalesce_window=0.1)
+        self.c.connect()
+        self.send(Event('default', 'USER_CONNECTED_TO_CHANNEL', 'elvis', '@elvis'))
+        self.send(Event('default', 'USER_DISCONNECTED_TO_CHANNEL', 'elvis', '@elvis'))
+        self.send(EVENT_1)
+        self.assertRaises(gevent.queue.Empty, self.events.get, timeout=0.05)
+        self.assertReceived(EVENT_1, 0.2)
+        self.assertEqual(self.events.qsize(), 0)
+        self.assertEqual(self.c.coalescer_stats()["collapsed"], 1)
+
     def test_disconnect(self):
         self.c.connect()
         self.c.disconnect()
@@ -0,0 +1,85 @@
+import unittest
+import gevent
+
+from beaconpush.eventclient import Event
+from beaconpush.eventqueue import EventQueue, COALESCE
+from beaconpush.outbox import DROP_OLDEST, DROP_NEWEST, BLOCK
+
+def event(user_id, name="USER_CONNECTED_TO_CHANNEL"):
+    return Event("default", name, user_id, "@" + user_id)
+
+class EventQueueTest(unittest.TestCase):
+    def user_ids(self, events):
+        return [e.user_id for e in events]
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, EventQueue, 10, "sometimes")
+
+    def test_get(self):
+        queue = EventQueue(10)
+        for user_id in ("hector", "elvis", "frank"):
+            queue.put(event(user_id))
+        self.assertEqual(self.user_ids(queue.get()), ["hector"])
+        self.assertEqual(self.user_ids(queue.get(None)), ["elvis", "frank"])
+        self.assertEqual(queue.stats(), {"depth": 0, "max_depth": 3, "received": 3, "dropped": 0, "coalesced": 0})
+
+    def test_get_waits(self):
+        queue = EventQueue(10)
+        gevent.spawn_later(0.05, queue.put, event("hector"))
+        self.assertEqual(self.user_ids(queue.get()), ["hector"])
+
+    def test_close(self):
+        queue = EventQueue(10)
+        queue.put(event("hector"))
+        waiter = gevent.spawn(lambda: [queue.get(), queue.get()])
+        gevent.sleep(0)
+        queue.close()
+        self.assertEqual([self.user_ids(events) for events in waiter.get(timeout=1)], [["hector"], []])
+
+        queue.open()
+        gevent.spawn_later(0.05, queue.put, event("elvis"))
+        self.assertEqual(self.user_ids(queue.get()), ["elvis"])
+
+    def test_drop_oldest(self):
+        queue = EventQueue(2, DROP_OLDEST)
+        for user_id in ("hector", "elvis", "frank"):
+            queue.put(event(user_id))
+        self.assertEqual(self.user_ids(queue.get(None)), ["elvis", "frank"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_drop_newest(self):
+        queue = EventQueue(2, DROP_NEWEST)
+        for user_id in ("hector", "elvis", "frank"):
+            queue.put(event(user_id))
+        self.assertEqual(self.user_ids(queue.get(None)), ["hector", "elvis"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_block(self):
+        queue = EventQueue(1, BLOCK)
+        queue.put(event("hector"))
+        putter = gevent.spawn(queue.put, event("elvis"))
+        gevent.sleep(0.01)
+        self.assertFalse(putter.ready())
+
+        self.assertEqual(self.user_ids(queue.get()), ["hector"])
+        putter.join(0.1)
+        self.assertEqual(self.user_ids(queue.get()), ["elvis"])
+
+    def test_coalesce(self):
+        queue = EventQueue(2, COALESCE)
+        queue.put(event("hector"))
+        queue.put(event("elvis"))
+        queue.put(event("hector", "USER_DISCONNECTED_TO_CHANNEL")) # Replaces the queued event of hector
+        queue.put(event("frank")) # Nothing to coalesce with, drops the oldest
+        events = queue.get(None)
+        self.assertEqual(self.user_ids(events), ["elvis", "frank"])
+        self.assertEqual((queue.coalesced, queue.dropped), (1, 1))
+
+        queue.put(event("hector"))
+        queue.put(event("elvis"))
+        queue.put(event("hector", "USER_DISCONNECTED_TO_CHANNEL"))
+        self.assertEqual([(e.user_id, e.name) for e in queue.get(None)],
+                         [("hector", "USER_DISCONNECTED_TO_CHANNEL"), ("elvis", "USER_CONNECTED_TO_CHANNEL")])
+
+if __name__ == '__main__':
+    unittest.main()
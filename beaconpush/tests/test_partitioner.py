@@ -0,0 +1,120 @@
+import unittest
+from zlib import adler32
+
+from beaconpush import Client
+from beaconpush.partitioner import Adler32Partitioner, ConsistentHashPartitioner, count_moved_keys
+from beaconpush.routecache import RouteCache
+
+HOSTS = ["10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]
+KEYS = ["user%d" % i for i in xrange(10000)]
+
+class PartitionerTest(unittest.TestCase):
+    def test_adler32_is_compatible(self):
+        p = Adler32Partitioner()
+        p.set_nodes(HOSTS)
+        for key in KEYS[:1000]:
+            self.assertEqual(p.get_node_index(key), adler32(key) % len(HOSTS))
+
+    def test_consistent_hash_spreads_keys(self):
+        p = ConsistentHashPartitioner()
+        p.set_nodes(HOSTS)
+        counts = [0] * len(HOSTS)
+        for key in KEYS:
+            counts[p.get_node_index(key)] += 1
+        for count in counts:
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_consistent_hash_weights(self):
+        p = ConsistentHashPartitioner(weights={"10.0.0.1": 3})
+        p.set_nodes(HOSTS[:2])
+        heavy = sum(1 for key in KEYS if p.get_node_index(key) == 0)
+        self.assertTrue(heavy > len(KEYS) * 0.6, heavy)
+
+    def test_count_moved_keys(self):
+        moved = count_moved_keys(HOSTS, HOSTS + ["10.0.0.5"], KEYS)
+        self.assertTrue(moved > len(KEYS) * 0.7, moved)
+
+        moved = count_moved_keys(HOSTS, HOSTS + ["10.0.0.5"], KEYS, ConsistentHashPartitioner)
+        self.assertTrue(moved < len(KEYS) * 0.3, moved)
+
+        moved = count_moved_keys(HOSTS, HOSTS[1:], KEYS, ConsistentHashPartitioner)
+        self.assertTrue(moved < len(KEYS) * 0.3, moved)
+
+    def test_client_routing(self):
+        c = Client(HOSTS, partitioner=ConsistentHashPartitioner())
+        before = c._get_user_node_index("hector")
+        c.add_client("10.0.0.5")
+        c.remove_client("10.0.0.5")
+        self.assertEqual(c._get_user_node_index("hector"), before)
+        self.assertEqual(c.hosts, HOSTS)
+    def test_client_routes_to_stable_handles(self):
+        c = Client(HOSTS)
+        routes = c._route_users(["user%d" % i for i in xrange(100)])
+        self.assertEqual(sorted(routes.keys()), sorted(c.handles))
+        for handle in routes.keys():
+            self.assertTrue(any(handle is h for h in c.handles))
+
+        routes = c._route_channels(["*global", "#lobby"])
+        self.assertEqual(len(routes), len(HOSTS))
+        self.assertEqual(routes[c._get_client("#lobby")], ["*global", "#lobby"])
+
+    def test_bulk_routing(self):
+        user_ids = ["user%d" % i for i in xrange(5000)] + range(5000)
+        c = Client(HOSTS)
+        routes = c._route_users(user_ids)
+        c.bulk_routing_threshold = len(user_ids) + 1
+        self.assertEqual(c._route_users(user_ids), routes)
+        self.assertEqual(sum(len(ids) for ids in routes.itervalues()), len(user_ids))
+
+        c.bulk_routing_threshold = 1
+        self.assertRaises(Exception, c._route_users, ["hector", "bad id"])
+        self.assertRaises(Exception, c._route_users, ["user%d" % i for i in xrange(1500)] + ["evil\nid"])
+
+    def test_get_node_indexes(self):
+        for partitioner in (Adler32Partitioner(), ConsistentHashPartitioner()):
+            partitioner.set_nodes(HOSTS)
+            self.assertEqual(list(partitioner.get_node_indexes(KEYS)), [partitioner.get_node_index(key) for key in KEYS])
+
+    def test_chunk_routes(self):
+        c = Client(HOSTS[:1])
+        c.max_ids_per_call = 3
+        chunks = c._chunk_routes(c._route_users(["user%d" % i for i in xrange(7)]))
+        self.assertEqual([len(user_ids) for client, user_ids in chunks], [3, 3, 1])
+
+class RouteCacheTest(unittest.TestCase):
+    def test_bounded(self):
+        cache = RouteCache(10)
+        for i in xrange(100):
+            cache.put(i, i % 4)
+        self.assertTrue(len(cache) <= 10)
+        self.assertEqual(cache.get(99), 3)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_keeps_recently_used(self):
+        cache = RouteCache(4)
+        cache.put("hot", 1)
+        for i in xrange(20):
+            cache.put(i, 0)
+            self.assertEqual(cache.get("hot"), 1)
+
+    def test_client_route_cache(self):
+        c = Client(HOSTS)
+        c._route_users(["hector", "elvis"])
+        c._route_users(["hector"])
+        self.assertEqual(c.route_cache_stats()["users"]["hits"], 1)
+        self.assertEqual(c.route_cache_stats()["users"]["misses"], 2)
+
+        # Invalid IDs are never cached
+        self.assertRaises(Exception, c._route_users, ["bad id"])
+        self.assertRaises(Exception, c._route_users, ["bad id"])
+
+        # Changing the topology invalidates all routes
+        c.add_client("10.0.0.5")
+        self.assertEqual(len(c.user_routes), 0)
+        routes = c._route_users(["user%d" % i for i in xrange(100)])
+        self.assertEqual(len(routes), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+from gevent import monkey; monkey.patch_socket()
+import unittest
+import gevent
+
+from beaconpush import Client, EventClient
+from beaconpush.eventclient import Event
+from beaconpush.presence import PresenceCache
+from beaconpush.tests import MockedBackendServer, MockedEventServer
+
+class PresenceCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = PresenceCache(ttl=0.05)
+        cache.put("hector", True)
+        self.assertEqual(cache.get("hector"), True)
+        gevent.sleep(0.06)
+        self.assertEqual(cache.get("hector"), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_negative_ttl(self):
+        cache = PresenceCache(ttl=10, negative_ttl=0)
+        cache.put("hector", False)
+        self.assertEqual(cache.get("hector"), None)
+
+        cache = PresenceCache(ttl=10)
+        cache.put("hector", False)
+        self.assertEqual(cache.get("hector"), False)
+
+    def test_bounded(self):
+        cache = PresenceCache(size=4)
+        for i in xrange(10):
+            cache.put("user%d" % i, True)
+        self.assertTrue(len(cache) <= 4)
+        self.assertEqual(cache.get("user9"), True)
+
+    def test_events(self):
+        cache = PresenceCache()
+        cache.put("elvis", True)
+        cache.handle_event(Event("default", "USER_CONNECTED_TO_CHANNEL", "hector", "@hector"))
+        cache.handle_event(Event("default", "USER_DISCONNECTED_TO_CHANNEL", "elvis", "@elvis"))
+        self.assertEqual(cache.get("hector"), True)
+        self.assertEqual(cache.get("elvis"), None)
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_events_of_other_operators_ignored(self):
+        cache = PresenceCache(operator="default")
+        cache.put("elvis", True)
+        cache.handle_event(Event("planet", "USER_CONNECTED_TO_CHANNEL", "hector", "@hector"))
+        cache.handle_event(Event("planet", "USER_DISCONNECTED_TO_CHANNEL", "elvis", "@elvis"))
+        self.assertEqual(cache.get("hector"), None)
+        self.assertEqual(cache.get("elvis"), True)
+
+        Client(['127.0.0.1'], operator="planet", presence_cache=cache)
+        self.assertEqual(cache.operator, "default")
+        self.assertEqual(Client(['127.0.0.1'], operator="planet", presence_cache=PresenceCache()).presence_cache.operator,
+                         "planet")
+
+class ClientPresenceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockedBackendServer()
+        self.port = self.server.start()
+        self.server.handler.users_online.add("hector")
+        self.cache = PresenceCache(ttl=10)
+        self.c = Client(['127.0.0.1'], port=self.port, presence_cache=self.cache)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_cached(self):
+        self.assertEqual(self.c.get_users_online(["hector", "elvis"]), {"hector": True, "elvis": False})
+        self.server.handler.users_online = set(["elvis"])
+        self.assertEqual(self.c.get_users_online(["hector", "elvis", "frank"]),
+                         {"hector": True, "elvis": False, "frank": False})
+        self.assertEqual(self.c.presence_cache_stats()["hits"], 2)
+
+    def test_failures_not_cached(self):
+        self.server.stop()
+        self.assertEqual(self.c.get_users_online(["hector"]), {"hector": False})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidated_by_events(self):
+        event_server = MockedEventServer()
+        event_client = EventClient('127.0.0.1', port=event_server.start(), handle=lambda e: None,
+                                   presence_cache=self.cache)
+        event_client.connect()
+        try:
+            self.assertEqual(self.c.get_users_online(["elvis"]), {"elvis": False})
+            event_server.send(str(Event("default", "USER_CONNECTED_TO_CHANNEL", "elvis", "@elvis")))
+            gevent.sleep(0.05)
+            self.assertEqual(self.c.get_users_online(["elvis"]), {"elvis": True})
+        finally:
+            event_client.disconnect()
+            event_server.running = False
+            event_server.server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+from gevent import monkey; monkey.patch_socket()
+import time
+import socket
+import unittest
+import gevent
+
+from beaconpush import Client
+from beaconpush.retry import RetryPolicy, RetryBudget, LatencyTracker
+from beaconpush.tests import MockedBackendServer
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_budget_refills_over_time(self):
+        budget = RetryBudget(ratio=0, min_per_second=100)
+        while budget.withdraw():
+            pass
+        gevent.sleep(0.05)
+        self.assertTrue(budget.withdraw())
+
+    def test_percentile(self):
+        tracker = LatencyTracker(size=100)
+        for i in xrange(200):
+            tracker.add(i)
+        self.assertEqual(len(tracker.samples), 100)
+        self.assertEqual(tracker.percentile(50), 150)
+        self.assertEqual(tracker.percentile(100), 199)
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=0.01, max_backoff=0.03)
+        for attempt in xrange(1, 5):
+            self.assertTrue(0 <= policy.backoff_delay(attempt) <= min(0.03, 0.01 * 2 ** (attempt - 1)))
+
+    def test_hedge_delay(self):
+        policy = RetryPolicy(hedge_percentile=90, min_hedge_samples=10)
+        for i in xrange(9):
+            policy.record_latency("getUsersOnline", 0.01)
+        self.assertEqual(policy.hedge_delay("getUsersOnline"), None)
+        policy.record_latency("getUsersOnline", 0.01)
+        self.assertEqual(policy.hedge_delay("getUsersOnline"), 0.01)
+        self.assertEqual(RetryPolicy().hedge_delay("getUsersOnline"), None)
+
+class ClientRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockedBackendServer()
+        self.port = self.server.start()
+        self.server.handler.users_online.add("hector")
+        self.failures = 0
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fail(self, times, method_name):
+        # Drops the connection instead of replying, the first times calls
+        method = getattr(self.server.handler, method_name)
+        def flaky(*args):
+            if self.failures < times:
+                self.failures += 1
+                raise socket.error("Dropped")
+            return method(*args)
+        setattr(self.server.handler, method_name, flaky)
+
+    def test_not_retried_by_default(self):
+        c = Client(['127.0.0.1'], port=self.port)
+        self.fail(1, "getUsersOnline")
+        self.assertEqual(c.get_users_online(["hector"]), {"hector": False})
+        self.assertEqual(self.failures, 1)
+        self.assertEqual(c.retry_stats(), None)
+
+    def test_retries(self):
+        c = Client(['127.0.0.1'], port=self.port, retry_policy=RetryPolicy())
+        self.fail(2, "getUsersOnline")
+        self.assertEqual(c.get_users_online(["hector"]), {"hector": True})
+        self.assertEqual(c.retry_stats(), {"retries": 2, "hedges": 0})
+
+    def test_max_attempts(self):
+        c = Client(['127.0.0.1'], port=self.port, retry_policy=RetryPolicy(max_attempts=2))
+        self.fail(2, "getNumUsersOnline")
+        self.assertEqual(c.get_num_users_online(), 0)
+        self.assertEqual(c.get_num_users_online(), 1)
+        self.assertEqual(c.retry_stats()["retries"], 1)
+
+    def test_out_of_budget(self):
+        budget = RetryBudget(ratio=0, min_per_second=0)
+        budget.withdraw()
+        c = Client(['127.0.0.1'], port=self.port, retry_policy=RetryPolicy(budget=budget))
+        self.fail(1, "getUsersOnline")
+        self.assertEqual(c.get_users_online(["hector"]), {"hector": False})
+        self.assertEqual(c.retry_stats()["retries"], 0)
+
+    def test_sends_not_retried(self):
+        c = Client(['127.0.0.1'], port=self.port, retry_policy=RetryPolicy())
+        self.fail(1, "sendUserMessage")
+        c.send_to_users("hello", ["hector"])
+        self.assertEqual(self.server.handler.user_messages, [])
+        self.assertEqual(c.retry_stats()["retries"], 0)
+
+    def test_hedged_request(self):
+        c = Client(['127.0.0.1'], port=self.port, retry_policy=RetryPolicy(hedge_percentile=50, min_hedge_samples=1))
+        c.get_users_online(["hector"]) # Latency sample
+
+        get_users_online = self.server.handler.getUsersOnline
+        def slow_once(*args):
+            self.failures += 1
+            if self.failures == 1:
+                gevent.sleep(0.5)
+            return get_users_online(*args)
+        self.server.handler.getUsersOnline = slow_once
+
+        start = time.time()
+        self.assertEqual(c.get_users_online(["hector"]), {"hector": True})
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(c.retry_stats(), {"retries": 0, "hedges": 1})
+
+        # The slow reply still comes in and its socket goes back to the pool
+        gevent.sleep(0.5)
+        pool = c.pool.get_pool(('127.0.0.1', self.port))
+        self.assertEqual(len(pool.free_sockets), 2)
+
+if __name__ == '__main__':
+    unittest.main()
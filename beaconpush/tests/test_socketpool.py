@@ -0,0 +1,147 @@
+from gevent import monkey; monkey.patch_socket()
+import socket
+import unittest
+import gevent
+
+from beaconpush import Client
+from beaconpush.socketpool import SocketPool
+from beaconpush.tests import MockedBackendServer
+
+class SocketPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockedBackendServer()
+        self.port = self.server.start()
+        self.addr = ('127.0.0.1', self.port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_lifo_reuse(self):
+        pool = SocketPool(self.addr)
+        first, second = pool.acquire_socket(), pool.acquire_socket()
+        pool.release_socket(first)
+        pool.release_socket(second)
+        self.assertTrue(pool.acquire_socket() is second)
+        self.assertTrue(pool.acquire_socket() is first)
+
+    def test_min_idle_prewarmed(self):
+        pool = SocketPool(self.addr, min_idle=3)
+        gevent.sleep(0.1)
+        self.assertEqual(len(pool.free_sockets), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_warmup(self):
+        pool = SocketPool(self.addr)
+        self.assertEqual(pool.warmup(), 0)
+        self.assertEqual(pool.warmup(2), 2)
+        self.assertEqual(pool.min_idle, 2)
+        self.assertEqual(pool.connected_sockets, 2)
+
+    def test_warmup_connect_timeout(self):
+        # A listener whose backlog is full, connecting to it hangs
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        addr = listener.getsockname()
+        backlog = []
+        for i in xrange(5):
+            sock = socket.socket()
+            sock.setblocking(0)
+            sock.connect_ex(addr)
+            backlog.append(sock)
+        gevent.sleep(0.1)
+
+        pool = SocketPool(addr, connect_timeout=0.1)
+        with gevent.Timeout(2):
+            self.assertRaises(Exception, pool.warmup, 1)
+        self.assertEqual(pool.connected_sockets, 0)
+
+    def test_disconnect_idle_sockets(self):
+        """Tests that the sockets idle for the longest time are disconnected, down to min_idle."""
+        pool = SocketPool(self.addr, idle_timeout=0.05, min_idle=1)
+        socks = [pool.acquire_socket() for i in xrange(3)]
+        for sock in socks:
+            pool.release_socket(sock)
+        gevent.sleep(0.1)
+
+        pool.disconnect_idle_sockets()
+        self.assertEqual(pool.connected_sockets, 1)
+        self.assertTrue(pool.acquire_socket() is socks[-1])
+
+    def test_disconnect_idle_sockets_keeps_recent(self):
+        pool = SocketPool(self.addr, idle_timeout=60)
+        socks = [pool.acquire_socket() for i in xrange(3)]
+        for sock in socks:
+            pool.release_socket(sock)
+
+        pool.disconnect_idle_sockets()
+        self.assertEqual(pool.connected_sockets, 3)
+        self.assertEqual([pool.acquire_socket() for i in xrange(3)], socks[::-1])
+
+    def test_disconnect_idle_sockets_in_one_pass(self):
+        pool = SocketPool(self.addr, max_sockets=40, idle_timeout=0.05)
+        socks = [pool.acquire_socket() for i in xrange(40)]
+        for sock in socks[:30]:
+            pool.release_socket(sock)
+        gevent.sleep(0.1)
+        for sock in socks[30:]:
+            pool.release_socket(sock)
+
+        pool.disconnect_idle_sockets()
+        self.assertEqual(pool.connected_sockets, 10)
+        self.assertEqual([sock for released_at, sock in pool.free_sockets], socks[30:])
+
+    def test_max_lifetime(self):
+        pool = SocketPool(self.addr, max_lifetime=0.05)
+        old = pool.acquire_socket()
+        pool.release_socket(old)
+        self.assertTrue(pool.acquire_socket() is old)
+
+        gevent.sleep(0.1)
+        pool.release_socket(old) # Closed rather than put back
+        self.assertEqual((pool.connected_sockets, len(pool.free_sockets)), (0, 0))
+        self.assertFalse(pool.acquire_socket() is old)
+
+    def test_max_lifetime_when_idle(self):
+        pool = SocketPool(self.addr, max_lifetime=0.05)
+        old = pool.acquire_socket()
+        pool.release_socket(old)
+        gevent.sleep(0.1)
+
+        self.assertFalse(pool.acquire_socket() is old)
+        self.assertEqual(pool.connected_sockets, 1)
+
+    def test_client_max_lifetime(self):
+        c = Client(['127.0.0.1'], port=self.port, max_lifetime=0.05)
+        self.assertTrue(c.pool is Client(['127.0.0.1'], max_lifetime=0.05).pool)
+        self.assertFalse(c.pool is Client(['127.0.0.1']).pool)
+
+        c.get_num_users_online()
+        pool = c.pool.get_pool(('127.0.0.1', self.port))
+        old = pool.free_sockets[-1][1]
+        gevent.sleep(0.1)
+        c.get_num_users_online()
+        self.assertFalse(pool.free_sockets[-1][1] is old)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_acquire_waits_for_release(self):
+        pool = SocketPool(self.addr, max_sockets=1)
+        sock = pool.acquire_socket()
+        gevent.spawn_later(0.05, pool.release_socket, sock)
+        self.assertTrue(pool.acquire_socket() is sock)
+
+        pool.timeout = 0.05
+        self.assertRaises(Exception, pool.acquire_socket)
+
+    def test_client_warmup(self):
+        c = Client(['127.0.0.1'], port=self.port)
+        self.assertEqual(c.warmup(), {'127.0.0.1': True})
+        gevent.sleep(0.05)
+        self.assertEqual(self.server.connections, 1)
+
+        self.server.stop()
+        c = Client(['127.0.0.1'], port=self.port + 1)
+        self.assertEqual(c.warmup(), {'127.0.0.1': False})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import gevent
+from gevent import socket
+from thrift.Thrift import TMessageType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from thrift.transport.TSocket import TSocket
+from thrift.transport.TTransport import TFramedTransport, TTransportException
+
+from beaconpush import codec
+from beaconpush.backend import BackendClient
+from beaconpush.generated_thrift import BackendService
+from beaconpush.transport import FramedSocketTransport
+
+USER_IDS = ["user%d" % i for i in xrange(2000)] # Well beyond the initial buffer size
+
+def socket_pair():
+    a, b = socket.socketpair()
+    ours, theirs = TSocket(), TSocket()
+    ours.setHandle(a)
+    theirs.setHandle(b)
+    return ours, theirs
+
+class FramedSocketTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, peer = socket_pair()
+        self.transport = FramedSocketTransport(self.sock, buffer_size=64)
+        self.peer = TFramedTransport(peer)
+
+    def tearDown(self):
+        self.transport.close()
+        self.peer.close()
+
+    def test_write(self):
+        client = BackendClient(TBinaryProtocol(self.transport))
+        server = BackendService.Client(TBinaryProtocol(self.peer))
+        for user_ids in (["hector"], USER_IDS, ["elvis"]):
+            writer = gevent.spawn(client.send_sendUserMessage, "default", user_ids, "hello")
+            self.assertEqual(server._iprot.readMessageBegin(), ("sendUserMessage", TMessageType.CALL, 0))
+            args = BackendService.sendUserMessage_args()
+            args.read(server._iprot)
+            server._iprot.readMessageEnd()
+            writer.join()
+            self.assertEqual((args.sphere, args.userIds, args.data), ("default", user_ids, "hello"))
+
+    def test_write_frame(self):
+        frame = codec.encode_request("getUsersOnline", 7, "default", USER_IDS)
+        writer = gevent.spawn(self.transport.write_frame, frame)
+        self.peer.readFrame()
+        writer.join()
+        self.assertEqual(str(frame[4:]), self.peer.cstringio_buf.getvalue())
+
+    def _reply(self, users_online):
+        protocol = TBinaryProtocol(self.peer)
+        protocol.writeMessageBegin("getUsersOnline", TMessageType.REPLY, 3)
+        BackendService.getUsersOnline_result(users_online).write(protocol)
+        protocol.writeMessageEnd()
+        self.peer.flush()
+
+    def test_read(self):
+        for protocol_class in (TBinaryProtocol, TBinaryProtocolAccelerated):
+            client = BackendClient(protocol_class(self.transport))
+            for users_online in (["hector"], USER_IDS, []):
+                gevent.spawn(self._reply, users_online)
+                self.assertEqual(client.read_reply(), ("getUsersOnline", TMessageType.REPLY, 3, users_online))
+
+    def test_read_frame(self):
+        gevent.spawn(self._reply, USER_IDS)
+        self.assertEqual(codec.decode_reply(self.transport.read_frame()), ("getUsersOnline", TMessageType.REPLY, 3, USER_IDS))
+
+    def test_read_closed(self):
+        self.peer.close()
+        self.assertRaises(TTransportException, self.transport.read_frame)
+
+if __name__ == '__main__':
+    unittest.main()
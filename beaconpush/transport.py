@@ -0,0 +1,153 @@
+# coding=UTF-8
+"""
+Framed transport working straight on the socket of a TSocket.
+
+TFramedTransport builds every frame in a StringIO, copies it into a new string
+together with the length prefix and hands it to TSocket, which copies it again
+for every partial send. Replies are read as strings that are concatenated and
+copied into yet another StringIO.
+
+FramedSocketTransport instead keeps one write buffer per connection, with room
+for the length prefix in front, and sends its contents through a memoryview
+with a single copy. Replies are read with recv_into into a reusable frame
+buffer that the read buffer wraps without copying.
+"""
+from cStringIO import StringIO
+from struct import pack, unpack_from
+from thrift.transport.TTransport import TTransportBase, CReadableTransport, TTransportException
+
+FRAME_PLACEHOLDER = "\0\0\0\0" # Reserves room for the length prefix of the frame
+
+class FramedSocketTransport(TTransportBase, CReadableTransport):
+    """
+    Drop-in replacement of TFramedTransport(sock) for a TSocket sock.
+    """
+    # Buffers grown beyond this size, by an unusually large frame, are not kept for the next frame
+    max_buffer_size = 1 << 20
+
+    def __init__(self, sock, buffer_size=4096):
+        """
+        @param sock: The TSocket to read and write frames on
+        @param buffer_size: Optional. Initial size of the read buffer. Defaults to 4096
+        """
+        self.sock = sock
+        self._wbuf = StringIO()
+        self._wbuf.write(FRAME_PLACEHOLDER)
+        self._frame = bytearray(buffer_size)
+        self._header = bytearray(4)
+        self._rbuf = StringIO("")
+
+    def isOpen(self):
+        return self.sock.isOpen()
+
+    def open(self):
+        return self.sock.open()
+
+    def close(self):
+        return self.sock.close()
+
+    def set_timeout(self, seconds):
+        """
+        Sets the timeout of the socket operations, in seconds, None to block.
+        """
+        self.sock.setTimeout(None if seconds is None else seconds * 1000)
+
+    def fileno(self):
+        return self._handle().fileno()
+
+    def read(self, sz):
+        ret = self._rbuf.read(sz)
+        if len(ret) != 0:
+            return ret
+
+        self.readFrame()
+        return self._rbuf.read(sz)
+
+    def readFrame(self):
+        frame = self.read_frame()
+        self._rbuf = StringIO(frame)
+
+    def read_frame(self):
+        """
+        read_frame() -> buffer
+
+        Reads the next frame. The returned buffer, without the length prefix, is only valid until the next
+        frame is read.
+        """
+        self._recv_into(self._header, 4)
+        size, = unpack_from('!i', self._header)
+
+        frame = self._frame
+        if size > len(frame):
+            frame = bytearray(max(size, 2 * len(frame)))
+            if len(frame) <= self.max_buffer_size:
+                self._frame = frame
+
+        self._recv_into(frame, size)
+        return buffer(frame, 0, size)
+
+    def write(self, buf):
+        self._wbuf.write(buf)
+
+    def flush(self):
+        wbuf = self._wbuf
+        size = wbuf.tell()
+        wbuf.seek(0)
+        wbuf.write(pack('!i', size - 4))
+        wbuf.seek(size)
+        frame = wbuf.getvalue()
+
+        # Reset before sending to preserve state on failure, like TFramedTransport. Truncating
+        # keeps the memory of the buffer for the next frame.
+        if size > self.max_buffer_size:
+            self._wbuf = StringIO()
+        else:
+            wbuf.seek(0)
+            wbuf.truncate()
+        self._wbuf.write(FRAME_PLACEHOLDER)
+
+        self._sendall(frame)
+
+    def write_frame(self, frame):
+        """
+        Writes a complete frame, length prefix included, such as those of beaconpush.codec.encode_request.
+        """
+        self._sendall(frame)
+
+    def _handle(self):
+        handle = self.sock.handle
+        if handle is None:
+            raise TTransportException(TTransportException.NOT_OPEN, "Transport not open")
+        return handle
+
+    def _sendall(self, data):
+        handle = self._handle()
+        sent = handle.send(data)
+        if sent < len(data):
+            # Send the rest through a memoryview, slicing data itself would copy it every time
+            handle.sendall(memoryview(data)[sent:])
+
+    def _recv_into(self, buf, size):
+        recv_into = self._handle().recv_into
+        view = buf
+        received = 0
+        while received < size:
+            chunk = recv_into(view, size - received)
+            if chunk == 0:
+                raise TTransportException(TTransportException.END_OF_FILE, "TSocket read 0 bytes")
+            received += chunk
+            if received < size:
+                view = memoryview(buf)[received:]
+
+    # Implement the CReadableTransport interface.
+    @property
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, prefix, reqlen):
+        # Same as TFramedTransport, fastbinary only asks for a refill once the buffer is empty
+        while len(prefix) < reqlen:
+            self.readFrame()
+            prefix += self._rbuf.getvalue()
+        self._rbuf = StringIO(prefix)
+        return self._rbuf
@@ -0,0 +1,102 @@
+"""
+Measures the overhead of Client operations, run with: python benchmarks/bench_calls.py
+
+Reports the wall time per operation, which includes the mocked backend, and the CPU time of the client alone.
+
+The Beaconpush nodes are served by a mocked backend in a forked process, listening on all interfaces so that
+127.0.0.1, 127.0.0.2, ... all reach it as distinct nodes. The client overhead is also measured on its own
+against a null backend, answering every call from memory.
+"""
+from gevent import monkey; monkey.patch_all()
+import os
+import signal
+import time
+
+from beaconpush import Client
+from beaconpush.client import ONLINE_DICT, ONLINE_SET, ONLINE_LIST
+from beaconpush.breaker import CircuitBreaker
+from beaconpush.tests import MockedBackendServer, find_unused_port
+
+NODES = 4
+NUMBER = 2000
+BULK_IDS = 20000
+
+def serve(port):
+    server = MockedBackendServer()
+    server.start('0.0.0.0', port)
+    server.handler.users_online.update("user%d" % i for i in xrange(0, BULK_IDS, 2))
+    server.server.serve_forever()
+
+class NullConnection(object):
+    """Connection of the null backend, replies are there as soon as requests are sent."""
+    replies = {"getNumUsersOnline": 1, "getUsersOnline": [], "generateToken": "token", "getUsersInChannel": []}
+
+    def set_timeout(self, seconds):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith("send_"):
+            return lambda *args: None
+
+        reply = self.replies.get(name[len("recv_"):], 1)
+        return lambda: reply
+
+class NullPool(object):
+    def __init__(self):
+        self.connection = NullConnection()
+        self.breaker = CircuitBreaker("null")
+
+    def get_breaker(self, addr):
+        return self.breaker
+
+    def acquire_socket(self, addr, timeout=None):
+        return self.connection
+
+    def release_socket(self, addr, sock, failed=False):
+        pass
+
+def bench(name, func, number=NUMBER):
+    func() # Connect
+    start, start_cpu = time.time(), time.clock()
+    for i in xrange(number):
+        func()
+    elapsed, cpu = time.time() - start, time.clock() - start_cpu
+    print "%-50s %8.1f us, client CPU %8.1f us" % (name, elapsed / number * 1000000, cpu / number * 1000000)
+
+def bench_operations(kind, c):
+    user_ids = ["user%d" % i for i in xrange(100)]
+    bench("%s get_num_users_online, %d nodes" % (kind, NODES), c.get_num_users_online)
+    bench("%s get_users_online, 1 id" % kind, lambda: c.get_users_online(["user1"]))
+    bench("%s send_to_users, 1 id" % kind, lambda: c.send_to_users("hello", ["user1"]))
+    bench("%s send_to_channels, 1 channel" % kind, lambda: c.send_to_channels("hello", ["#lobby"]))
+    bench("%s generate_token, remote" % kind, lambda: c.generate_token("user1", remote=True))
+    bench("%s send_to_users, 100 ids over %d nodes" % (kind, NODES), lambda: c.send_to_users("hello", user_ids))
+
+    bulk_ids = ["user%d" % i for i in xrange(BULK_IDS)]
+    for result_format in (ONLINE_DICT, ONLINE_SET, ONLINE_LIST):
+        bench("%s get_users_online, %d ids, %s" % (kind, BULK_IDS, result_format),
+              lambda: c.get_users_online(bulk_ids, result_format), number=20)
+
+def main():
+    port = find_unused_port()
+    pid = os.fork()
+    if pid == 0:
+        serve(port)
+        os._exit(0)
+
+    try:
+        time.sleep(0.5)
+        hosts = ["127.0.0.%d" % (i + 1) for i in xrange(NODES)]
+        for pipelined in (False, True):
+            bench_operations("pipelined" if pipelined else "pooled", Client(hosts, port=port, pipelined=pipelined))
+
+        c = Client(hosts, port=port)
+        c.pool = NullPool()
+        for client in c.clients:
+            client._pool = c.pool
+        bench_operations("null backend", c)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+if __name__ == '__main__':
+    main()
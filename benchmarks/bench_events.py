@@ -0,0 +1,72 @@
+"""
+Measures how fast EventClient takes events off the wire, run with: python benchmarks/bench_events.py
+
+Events are written by a forked process as fast as it can, the client handles them with a handler that only
+counts them, so that the time is that of reading, unframing and dispatching.
+"""
+from gevent import monkey; monkey.patch_all()
+import os
+import signal
+import socket
+import time
+
+import gevent
+
+from beaconpush import EventClient
+from beaconpush.eventclient import Event
+from beaconpush.tests import find_unused_port
+
+NUMBER = 200000
+EVENT = str(Event("my-web-site", "USER_CONNECTED_TO_CHANNEL", "hector", "@hector"))
+LONG_EVENT = str(Event("my-web-site", "USER_CONNECTED_TO_CHANNEL", "hector", "@" + "h" * 3000))
+
+def serve(port, event, number):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+    sock, addr = listener.accept()
+    chunk = event * max(65536 // len(event), 1)
+    per_chunk = len(chunk) // len(event)
+    for i in xrange(number // per_chunk):
+        sock.sendall(chunk)
+    time.sleep(60)
+
+def bench(name, event, number=NUMBER, spawn=None, batch=False, **kwargs):
+    port = find_unused_port()
+    pid = os.fork()
+    if pid == 0:
+        serve(port, event, number)
+        os._exit(0)
+
+    try:
+        time.sleep(0.2)
+        per_chunk = max(65536 // len(event), 1)
+        expected = number // per_chunk * per_chunk
+        counter = [0]
+        done = gevent.event.Event()
+        def handle_batch(events):
+            counter[0] += len(events)
+            if counter[0] == expected:
+                done.set()
+
+        if batch:
+            c = EventClient('127.0.0.1', port=port, handle_batch=handle_batch, spawn=spawn, **kwargs)
+        else:
+            c = EventClient('127.0.0.1', port=port, handle=lambda e: handle_batch((e, )), spawn=spawn, **kwargs)
+        start, start_cpu = time.time(), time.clock()
+        c.connect()
+        done.wait(60)
+        elapsed, cpu = time.time() - start, time.clock() - start_cpu
+        c.disconnect()
+        print "%-45s %8.0f events/s, %6.2f us CPU per event" % (name, counter[0] / elapsed, cpu / counter[0] * 1000000)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+
+if __name__ == '__main__':
+    bench("%d byte events" % len(EVENT), EVENT)
+    bench("%d byte events" % len(LONG_EVENT), LONG_EVENT, NUMBER // 10)
+    bench("%d byte events, pool of 20" % len(EVENT), EVENT, spawn=20)
+    bench("%d byte events, batches, pool of 20" % len(EVENT), EVENT, spawn=20, batch=True)
+    bench("%d byte events, queue, 20 workers" % len(EVENT), EVENT, queue_size=10000)
+    bench("%d byte events, queue, batches, 20 workers" % len(EVENT), EVENT, batch=True, queue_size=10000)
@@ -0,0 +1,86 @@
+"""
+Compares the pure Python and the accelerated Thrift protocol, run with: python benchmarks/bench_protocol.py
+"""
+import timeit
+from thrift.Thrift import TMessageType
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from thrift.transport.TTransport import TMemoryBuffer, TFramedTransport
+
+from beaconpush import codec
+from beaconpush.backend import BackendClient, PreparedMessage
+from beaconpush.generated_thrift import BackendService
+from beaconpush.socketpool import fastbinary
+
+USER_IDS = ["user%d" % i for i in xrange(1000)]
+DATA = '{"type": "notification", "text": "%s"}' % ("x" * 1000)
+
+class NullBuffer(TMemoryBuffer):
+    """Discards everything written, so only the encoding is measured."""
+    def write(self, buf):
+        pass
+
+    def flush(self):
+        pass
+
+def reply_frame(protocol_class):
+    buf = TMemoryBuffer()
+    protocol = TBinaryProtocol(buf)
+    protocol.writeMessageBegin("getUsersOnline", TMessageType.REPLY, 0)
+    BackendService.getUsersOnline_result(USER_IDS).write(protocol)
+    protocol.writeMessageEnd()
+    return buf.getvalue()
+
+def bench(name, func, number=200):
+    best = min(timeit.Timer(func).repeat(repeat=5, number=number)) / number
+    print "%-60s %8.1f us" % (name, best * 1000000)
+
+def main():
+    if fastbinary is None:
+        print "Thrift fastbinary extension not available, only the pure Python protocol is measured."
+
+    protocols = [TBinaryProtocol]
+    if fastbinary is not None:
+        protocols.append(TBinaryProtocolAccelerated)
+
+    prepared = PreparedMessage(DATA)
+    for protocol_class in protocols:
+        client = BackendClient(protocol_class(NullBuffer()))
+        bench("%s sendUserMessage, %d ids" % (protocol_class.__name__, len(USER_IDS)),
+              lambda: client.send_sendUserMessage("default", USER_IDS, DATA))
+        bench("%s sendUserMessage, %d ids, prepared" % (protocol_class.__name__, len(USER_IDS)),
+              lambda: client.send_sendUserMessage("default", USER_IDS, prepared))
+
+        frame = reply_frame(protocol_class)
+        def read():
+            # Framed like on the wire, so that the accelerated protocol reads from a CReadableTransport
+            transport = TFramedTransport(TMemoryBuffer(frame_header(frame) + frame))
+            BackendClient(protocol_class(transport)).recv_getUsersOnline()
+        bench("%s getUsersOnline reply, %d ids" % (protocol_class.__name__, len(USER_IDS)), read)
+
+    bench("codec sendUserMessage, %d ids" % len(USER_IDS),
+          lambda: codec.encode_request("sendUserMessage", 0, "default", USER_IDS, DATA))
+    bench("codec sendUserMessage, %d ids, prepared" % len(USER_IDS),
+          lambda: codec.encode_request("sendUserMessage", 0, "default", USER_IDS, prepared))
+    frame = reply_frame(TBinaryProtocol)
+    bench("codec getUsersOnline reply, %d ids" % len(USER_IDS), lambda: codec.decode_reply(frame))
+    bench("codec getNumUsersOnline round trip",
+          lambda: (codec.encode_request("getNumUsersOnline", 0, "default"), codec.decode_reply(NUM_ONLINE_FRAME)))
+    client = BackendClient(TBinaryProtocol(NullBuffer()))
+    bench("TBinaryProtocol getNumUsersOnline request", lambda: client.send_getNumUsersOnline("default"))
+
+def small_reply_frame():
+    buf = TMemoryBuffer()
+    protocol = TBinaryProtocol(buf)
+    protocol.writeMessageBegin("getNumUsersOnline", TMessageType.REPLY, 0)
+    BackendService.getNumUsersOnline_result(42).write(protocol)
+    protocol.writeMessageEnd()
+    return buf.getvalue()
+
+NUM_ONLINE_FRAME = small_reply_frame()
+
+def frame_header(frame):
+    import struct
+    return struct.pack("!i", len(frame))
+
+if __name__ == '__main__':
+    main()
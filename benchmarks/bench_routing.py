@@ -0,0 +1,40 @@
+"""
+Micro-benchmark of user routing, run with: python benchmarks/bench_routing.py
+"""
+import gc, timeit
+
+from beaconpush import Client
+
+HOSTS = ["10.0.0.%d" % i for i in xrange(1, 9)]
+USER_IDS = ["user%d" % i for i in xrange(10000)]
+BROADCAST_IDS = ["user%d" % i for i in xrange(100000, 150000)]
+
+def count_objects(func):
+    gc.collect()
+    before = len(gc.get_objects())
+    result = func()
+    after = len(gc.get_objects())
+    del result
+    return after - before
+
+def main():
+    cold = Client(HOSTS, route_cache_size=0)
+    cold.bulk_routing_threshold = len(BROADCAST_IDS) + 1
+    warm = Client(HOSTS, route_cache_size=len(USER_IDS) * 2)
+    warm.bulk_routing_threshold = len(BROADCAST_IDS) + 1
+    warm._route_users(USER_IDS)
+    bulk = Client(HOSTS)
+
+    for name, client in (("cold cache", cold), ("warm cache", warm)):
+        timer = timeit.Timer(lambda: client._route_users(USER_IDS))
+        best = min(timer.repeat(repeat=5, number=10)) / 10
+        print "_route_users, %d ids, %s: %.2f ms, %d objects allocated" % (
+            len(USER_IDS), name, best * 1000, count_objects(lambda: client._route_users(USER_IDS)))
+
+    for name, client in (("per id", cold), ("bulk", bulk)):
+        timer = timeit.Timer(lambda: client._route_users(BROADCAST_IDS))
+        best = min(timer.repeat(repeat=5, number=1))
+        print "_route_users, %d ids, %s: %.2f ms" % (len(BROADCAST_IDS), name, best * 1000)
+
+if __name__ == '__main__':
+    main()
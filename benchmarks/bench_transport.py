@@ -0,0 +1,64 @@
+"""
+Compares TFramedTransport and FramedSocketTransport over a socket pair, run with: python benchmarks/bench_transport.py
+
+Only the transports are measured: a frame is written with a single write and flush, and replies are read
+one frame at a time. The other end of the socket pair runs in a forked process.
+"""
+import os
+import socket
+import struct
+import timeit
+from thrift.transport.TSocket import TSocket
+from thrift.transport.TTransport import TFramedTransport
+
+from beaconpush.transport import FramedSocketTransport
+
+NUMBER = 200
+REPEAT = 5
+
+def socket_pair(peer_task, *args):
+    a, b = socket.socketpair()
+    if os.fork() == 0:
+        a.close()
+        try:
+            peer_task(b, *args)
+        finally:
+            os._exit(0)
+
+    b.close()
+    sock = TSocket()
+    sock.setHandle(a)
+    return sock
+
+def drain(peer):
+    while peer.recv(1 << 20):
+        pass
+
+def feed(peer, frame, count):
+    data = struct.pack("!i", len(frame)) + frame
+    for i in xrange(count):
+        peer.sendall(data)
+
+def bench(name, func):
+    best = min(timeit.Timer(func).repeat(repeat=REPEAT, number=NUMBER)) / NUMBER
+    print "%-60s %8.1f us" % (name, best * 1000000)
+
+def main():
+    for size in (1024, 64 * 1024, 1024 * 1024):
+        payload = "x" * size
+        for transport_class in (TFramedTransport, FramedSocketTransport):
+            transport = transport_class(socket_pair(drain))
+            def write():
+                transport.write(payload)
+                transport.flush()
+            bench("%s write, %d bytes" % (transport_class.__name__, size), write)
+            transport.close()
+
+            transport = transport_class(socket_pair(feed, payload, REPEAT * NUMBER))
+            bench("%s read, %d bytes" % (transport_class.__name__, size), transport.readFrame)
+            transport.close()
+
+    os.wait()
+
+if __name__ == '__main__':
+    main()